@@ -1,37 +1,173 @@
 """key_value.py"""
 
-class KeyValue:
-    """A key-value store used to manage contexts, queries, and responses."""
+import sys
+import zlib
+import threading
+from contextlib import contextmanager, ExitStack
+
+NUM_SHARDS = 16  # Contexts are spread over this many independently locked shards
+NO_ANSWER = "No answer chosen"
+SUMMARY_HEADER = "Summary of earlier queries:"
+SUMMARY_FIELD_CHARS = 100  # Characters of a query and of its answer kept in a summary line
+
+
+def render_turn(query, answer):
+    return f"Query: {query}\nAnswer: {answer if answer is not None else NO_ANSWER}"
+
+
+class ReadWriteLock:
+    """
+    Lock held by any number of readers or by a single writer.
+    A waiting writer keeps new readers out so writers are not starved. Not reentrant.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.writer = False
+        self.waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        with self.condition:
+            self.condition.wait_for(lambda: not self.writer and not self.waiting_writers)
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.readers -= 1
+                if not self.readers:
+                    self.condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self.condition:
+            self.waiting_writers += 1
+            self.condition.wait_for(lambda: not self.writer and not self.readers)
+            self.waiting_writers -= 1
+            self.writer = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writer = False
+                self.condition.notify_all()
+
+
+class Shard:
+    """A slice of the contexts, guarded by its own lock."""
+
+    __slots__ = ("lock", "contexts")
 
     def __init__(self):
+        self.lock = ReadWriteLock()
+        self.contexts = {}  # {context_id: Context}
+
+
+class Context:
+    """
+    The turns of one context stored as parallel columns indexed by turn number,
+    so each turn keeps exactly one reference to its query and to its answer.
+    """
+
+    __slots__ = ("queries", "answers", "rendered", "summary_lines")
+
+    def __init__(self, queries=None, answers=None):
+        self.queries = queries if queries is not None else []  # Interned query strings
+        self.answers = answers if answers is not None else [None] * len(self.queries)  # Interned answer or None
+        self.rendered = {}  # {turn: rendered turn} for the turns of the latest prompt window only
+        self.summary_lines = []  # Summary line of each turn folded out of the prompt window so far
+
+
+class KeyValue:
+    """
+    A key-value store used to manage contexts, queries, and responses.
+    Safe to use from several threads: contexts are spread over shards by a hash
+    of their ID, and operations on contexts in different shards run concurrently.
+    """
+
+    def __init__(self, num_shards=NUM_SHARDS):
         """
         Nik
-        Initializes the KeyValue storage with an empty dictionary.
-        Each context and its associated queries are stored in a nested structure.
+        Initializes the KeyValue storage with empty shards.
+        Each context is a Context record holding its turns in order.
         """
-        self.data = {}
+        self.shards = [Shard() for _ in range(num_shards)]
+
+    def _shard(self, context_id):
+        return self.shards[zlib.crc32(context_id.encode()) % len(self.shards)]
+
+    def __contains__(self, context_id):
+        shard = self._shard(context_id)
+        with shard.lock.read():
+            return context_id in shard.contexts
+
+    def replace_with(self, other):
+        """
+        Atomically swap in the contexts of another KeyValue with the same number of
+        shards, e.g. one staged from a snapshot. Every shard is locked for writing
+        (always in the same order) so no reader sees a mix of old and new state.
+        """
+        with ExitStack() as stack:
+            for shard in self.shards:
+                stack.enter_context(shard.lock.write())
+            for shard, new_shard in zip(self.shards, other.shards):
+                shard.contexts = new_shard.contexts
 
     def to_dict(self):
         """
         Convert the KeyValue object to a dictionary format that can be serialized to JSON.
         Returns:
-            dict: The internal data of the KeyValue object.
+            dict: {context_id: {"queries": [query], "answers": [answer or None]}}
+        """
+        return dict(self.iter_contexts())
+
+    def iter_contexts(self):
+        """
+        Yield the serialized form of one context at a time, so large stores can be
+        written out without building the whole dictionary first.
+        Yields:
+            tuple: (context_id, {"queries": [query], "answers": [answer or None]})
         """
-        return self.data
+        for shard in self.shards:
+            # Copy the shard's contexts under its lock, then yield them without holding it
+            with shard.lock.read():
+                serialized = [(context_id, {"queries": list(context.queries), "answers": list(context.answers)})
+                              for context_id, context in shard.contexts.items()]
+            yield from serialized
 
     @classmethod
     def from_dict(cls, data):
         """
         Create a KeyValue object from a dictionary.
         Args:
-            data (dict): A dictionary representation of a KeyValue object.
+            data (dict): A dictionary representation of a KeyValue object, either
+                from to_dict() or in the older {"queries", "responses": {query: answer}} form.
         Returns:
             KeyValue: A new KeyValue object initialized with the provided data.
         """
         kv = cls()
-        kv.data = data
+        kv.load_contexts(data)
         return kv
 
+    def load_contexts(self, data):
+        """
+        Add or replace contexts from their serialized form.
+        """
+        for context_id, context_data in data.items():
+            queries = [sys.intern(query) for query in context_data["queries"]]
+            if "answers" in context_data:
+                answers = [sys.intern(answer) if answer is not None else None for answer in context_data["answers"]]
+            else:
+                # Older format: answers were keyed by query text
+                responses = context_data.get("responses", {})
+                answers = [sys.intern(responses[query]) if query in responses else None for query in queries]
+
+            shard = self._shard(context_id)
+            with shard.lock.write():
+                shard.contexts[context_id] = Context(queries, answers)
+
     def create_context(self, context_id):
         """
         Nik
@@ -39,11 +175,13 @@ class KeyValue:
         Args:
             context_id (str): A unique identifier for the context.
         """
-        if context_id in self.data:
-            print(f"DEBUG: Key-Value: Context with ID '{context_id}' already exists.")
-        else:
-            self.data[context_id] = {"queries": [], "responses": {}}
-            # print(f"DEBUG: Key-Value: Context '{context_id}' created successfully.")
+        shard = self._shard(context_id)
+        with shard.lock.write():
+            if context_id in shard.contexts:
+                print(f"DEBUG: Key-Value: Context with ID '{context_id}' already exists.")
+            else:
+                shard.contexts[context_id] = Context()
+                # print(f"DEBUG: Key-Value: Context '{context_id}' created successfully.")
 
     def create_query(self, context_id, query_string):
         """
@@ -53,33 +191,41 @@ class KeyValue:
             context_id (str): The identifier of the context.
             query_string (str): The query to add within the context.
         """
-        if context_id not in self.data:
-            # print(f"Context '{context_id}' does not exist. Please create it first.")
-            return
+        shard = self._shard(context_id)
+        with shard.lock.write():
+            if context_id not in shard.contexts:
+                # print(f"Context '{context_id}' does not exist. Please create it first.")
+                return
 
-        self.data[context_id]["queries"].append(query_string)
+            context = shard.contexts[context_id]
+            context.queries.append(sys.intern(query_string))
+            context.answers.append(None)
         # print(f"DEBUG: Key-Value: Query added to context '{context_id}': {query_string}")
 
-    def save_answer(self, context_id, response):
+    def save_answer(self, context_id, response, turn=-1):
         """
         Nik
-        Saves a selected answer to a specific query in a context.
+        Saves a selected answer to a turn of a context.
         Args:
             context_id (str): The identifier of the context.
             response (str): Response to save.
+            turn (int): Index of the turn to answer, the latest query by default.
         """
-        if context_id not in self.data:
-            print(f"Context '{context_id}' does not exist.")
-            return
+        shard = self._shard(context_id)
+        with shard.lock.write():
+            if context_id not in shard.contexts:
+                print(f"Context '{context_id}' does not exist.")
+                return
 
-        queries = self.data[context_id]["queries"]
-        if not queries:
-            print(f"No queries exist in context '{context_id}' to associate the response with.")
-            return
+            context = shard.contexts[context_id]
+            if not context.queries:
+                print(f"No queries exist in context '{context_id}' to associate the response with.")
+                return
 
-        # Associate the response with the latest query
-        latest_query = queries[-1]
-        self.data[context_id]["responses"][latest_query] = response
+            # Associate the response with the turn only, an earlier identical query keeps its answer
+            turn = turn % len(context.queries)
+            context.answers[turn] = sys.intern(response)
+            context.rendered.pop(turn, None)
         # print(f"Key Value: Response saved for the latest query '{latest_query}': {response}")
 
     def view(self, context_id):
@@ -89,42 +235,98 @@ class KeyValue:
         Args:
             context_id (str): The identifier of the context.
         Returns:
-            dict: The context data if it exists, otherwise None.
+            str: The formatted context if it exists, otherwise None.
         """
-        if context_id not in self.data:
-            return None
+        shard = self._shard(context_id)
+        with shard.lock.read():
+            if context_id not in shard.contexts:
+                return None
 
-        context_data = self.data[context_id]
-        queries = context_data["queries"]
-        responses = context_data["responses"]
+            context = shard.contexts[context_id]
+            return "\n".join(render_turn(query, answer) for query, answer in zip(context.queries, context.answers))
 
-        # Build a formatted string for the queries and answers
-        formatted_output = []
-        for query in queries:
-            answer = responses.get(query, "No answer chosen")
-            formatted_output.append(f"Query: {query}\nAnswer: {answer}")
+    def prompt(self, context_id, budget, summary_budget=0):
+        """
+        Build the transcript sent to the LLM for a context, bounded in size.
+        The most recent turns that fit in budget characters are kept whole (the
+        latest turn is always kept), and with a summary_budget the turns before
+        them are folded into a summary of at most that many characters.
+        Rendered turns of the window are cached until they leave it, so the shard is
+        locked for writing while the prompt is built.
+        Args:
+            context_id (str): The identifier of the context.
+            budget (int): Maximum characters of verbatim turns.
+            summary_budget (int): Maximum characters of the summary, 0 for none.
+        Returns:
+            str: The prompt if the context exists, otherwise None.
+        """
+        shard = self._shard(context_id)
+        with shard.lock.write():
+            if context_id not in shard.contexts:
+                return None
+            return self._prompt(shard.contexts[context_id], budget, summary_budget)
+
+    def _prompt(self, context, budget, summary_budget):
+        # Walk back from the latest turn until the budget is used up
+        num_turns = len(context.queries)
+        window = []
+        start = num_turns
+        size = 0
+        while start > 0:
+            turn = start - 1
+            if turn not in context.rendered:
+                context.rendered[turn] = render_turn(context.queries[turn], context.answers[turn])
+            rendered = context.rendered[turn]
+            if start < num_turns and size + len(rendered) + 1 > budget:
+                break
+            window.append(rendered)
+            size += len(rendered) + 1
+            start -= 1
 
-        return "\n".join(formatted_output)
-    
-    
+        # Forget rendered turns that fell out of the window
+        for turn in [turn for turn in context.rendered if turn < start]:
+            del context.rendered[turn]
+
+        window = "\n".join(reversed(window))
+        if start == 0 or summary_budget <= 0:
+            return window
+        return self._summary(context, start, summary_budget) + "\n" + window
+
+    def _summary(self, context, folded, summary_budget):
+        """
+        Summarize the first folded turns of a context as one line per turn, keeping the
+        latest lines that fit in summary_budget. Lines are cached and only the turns
+        folded since the last call are summarized.
+        """
+        lines = context.summary_lines
+        if len(lines) > folded:
+            del lines[folded:]  # The window grew back over turns that were folded
+
+        for turn in range(len(lines), folded):
+            answer = context.answers[turn] if context.answers[turn] is not None else NO_ANSWER
+            lines.append(f"- {context.queries[turn][:SUMMARY_FIELD_CHARS]} -> {answer[:SUMMARY_FIELD_CHARS]}")
+
+        kept = []
+        size = len(SUMMARY_HEADER)
+        for line in reversed(lines):
+            if size + len(line) + 1 > summary_budget:
+                break
+            kept.append(line)
+            size += len(line) + 1
+        return "\n".join([SUMMARY_HEADER] + kept[::-1])
 
     def view_all(self):
         """
         Nik
-        Retrieves all contexts and their associated data.
-        Returns:
-            dict: A dictionary where each key is a context ID and the value is a list of query-answer pairs.
-        """
-        if not self.data:
-            return {}
-
-        # Build structured data for all contexts
-        result = {}
-        for context_id, context_data in self.data.items():
-            queries = context_data["queries"]
-            responses = context_data["responses"]
-            result[context_id] = [
-                {"query": query, "answer": responses.get(query, "No answer chosen")}
-                for query in queries
-            ]
-        return result
+        Retrieves all contexts and their associated data, one context at a time.
+        Yields:
+            tuple: (context ID, iterator of (query, answer) pairs in turn order).
+        """
+        for shard in self.shards:
+            # Snapshot the shard's columns under its lock so appends during display are not seen
+            with shard.lock.read():
+                contexts = [(context_id, list(context.queries), list(context.answers))
+                            for context_id, context in shard.contexts.items()]
+            for context_id, queries, answers in contexts:
+                answers = (answer if answer is not None else NO_ANSWER for answer in answers)
+                yield context_id, zip(queries, answers)
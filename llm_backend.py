@@ -0,0 +1,162 @@
+"""llm_backend.py"""
+
+import os
+import time
+import random
+import hashlib
+import threading
+
+GEMINI_MODEL = "gemini-1.5-flash"
+FAKE_STREAM_PIECE = 32  # Characters per piece when the fake backend streams
+
+
+class TransientLLMError(Exception):
+    """A failure worth retrying, such as throttling or a timeout."""
+
+
+class LLMBackend:
+    """
+    Interface every LLM backend implements.
+    name identifies the model (it is part of the response cache key) and
+    generate() returns the response text or raises on failure, giving up after
+    timeout seconds. stream() yields the response in pieces as they are generated.
+    """
+
+    name = "base"
+
+    def generate(self, prompt, timeout=None):
+        raise NotImplementedError
+
+    def stream(self, prompt, timeout=None):
+        """
+        Backends without streaming yield the whole response as one piece.
+        """
+        yield self.generate(prompt, timeout)
+
+    def is_transient(self, error):
+        """
+        Returns:
+            bool: True if a call that failed with error may succeed when retried.
+        """
+        return isinstance(error, (TransientLLMError, TimeoutError, ConnectionError))
+
+
+class GeminiBackend(LLMBackend):
+    """
+    Google Gemini through google.generativeai, configured from GEMINI_API_KEY
+    (read from .env if present). The package is only imported when this backend
+    is used.
+    """
+
+    def __init__(self, model_name=GEMINI_MODEL):
+        import google.generativeai as genai
+        from dotenv import load_dotenv
+
+        # Load environment variables from .env file and configure the Gemini API with them
+        load_dotenv()
+        genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+
+        self.name = model_name
+        self.model = genai.GenerativeModel(model_name)
+
+    def generate(self, prompt, timeout=None):
+        request_options = {"timeout": timeout} if timeout is not None else None
+        return self.model.generate_content(prompt, request_options=request_options).text
+
+    def stream(self, prompt, timeout=None):
+        request_options = {"timeout": timeout} if timeout is not None else None
+        for chunk in self.model.generate_content(prompt, stream=True, request_options=request_options):
+            yield chunk.text
+
+    def is_transient(self, error):
+        from google.api_core import exceptions
+
+        # Throttling, timeouts and server side errors
+        transient_errors = (exceptions.TooManyRequests, exceptions.ServiceUnavailable, exceptions.DeadlineExceeded, exceptions.InternalServerError)
+        return isinstance(error, transient_errors) or super().is_transient(error)
+
+
+class FakeBackend(LLMBackend):
+    """
+    Local stand-in for benchmarking the cluster without the network or an API key.
+    Responses are derived from a hash of the prompt, so the same prompt always
+    gets the same response. Latency and failures are drawn from a seeded
+    random generator. When streamed the response is split into pieces of
+    FAKE_STREAM_PIECE characters with the latency spread evenly between them.
+    Args:
+        latency (str): "<distribution>:<parameters>" in seconds, one of
+            fixed:<s>, uniform:<low>,<high>, exponential:<mean> or lognormal:<mu>,<sigma>.
+        error_rate (float): Probability that a call raises instead of answering.
+        response_size (int): Length of every response in characters.
+        seed (int): Seed for the latency and error draws.
+    """
+
+    def __init__(self, latency="fixed:0", error_rate=0.0, response_size=256, seed=0):
+        self.name = f"fake-{response_size}"  # Responses only depend on the prompt and size
+        self.sample_latency = parse_latency(latency)
+        self.error_rate = error_rate
+        self.response_size = response_size
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()  # random.Random is shared by the LLM pool threads
+
+    def generate(self, prompt, timeout=None):
+        return "".join(self.stream(prompt, timeout))
+
+    def stream(self, prompt, timeout=None):
+        with self.lock:
+            delay = max(0.0, self.sample_latency(self.random))
+            failed = self.random.random() < self.error_rate
+
+        if failed:
+            raise TransientLLMError("fake backend injected error")
+
+        digest = hashlib.sha256(prompt.encode()).hexdigest()
+        response = (digest * (self.response_size // len(digest) + 1))[:self.response_size]
+        pieces = [response[start:start + FAKE_STREAM_PIECE] for start in range(0, len(response), FAKE_STREAM_PIECE)] or [""]
+
+        elapsed = 0.0
+        for piece in pieces:
+            piece_delay = delay / len(pieces)
+            if timeout is not None and elapsed + piece_delay > timeout:
+                time.sleep(max(0.0, timeout - elapsed))
+                raise TimeoutError(f"fake backend took longer than {timeout:.2f}s")
+            time.sleep(piece_delay)
+            elapsed += piece_delay
+            yield piece
+
+
+def parse_latency(spec):
+    """
+    Turn a latency spec like "uniform:0.1,0.5" into a function drawing one latency from a random.Random.
+    """
+    distribution, _, parameters = spec.partition(":")
+    values = [float(value) for value in parameters.split(",") if value]
+
+    if distribution == "fixed":
+        return lambda rng: values[0]
+    if distribution == "uniform":
+        return lambda rng: rng.uniform(values[0], values[1])
+    if distribution == "exponential":
+        return lambda rng: rng.expovariate(1 / values[0]) if values[0] > 0 else 0.0
+    if distribution == "lognormal":
+        return lambda rng: rng.lognormvariate(values[0], values[1])
+    raise ValueError(f"Unknown latency distribution '{distribution}'")
+
+
+def create_backend():
+    """
+    Build the backend chosen by the LLM_BACKEND environment variable (gemini or fake).
+    The fake reads FAKE_LLM_LATENCY, FAKE_LLM_ERROR_RATE, FAKE_LLM_RESPONSE_SIZE and FAKE_LLM_SEED.
+    """
+    backend = os.getenv("LLM_BACKEND", "gemini")
+
+    if backend == "gemini":
+        return GeminiBackend(os.getenv("GEMINI_MODEL", GEMINI_MODEL))
+    if backend == "fake":
+        return FakeBackend(
+            latency=os.getenv("FAKE_LLM_LATENCY", "fixed:0"),
+            error_rate=float(os.getenv("FAKE_LLM_ERROR_RATE", "0")),
+            response_size=int(os.getenv("FAKE_LLM_RESPONSE_SIZE", "256")),
+            seed=int(os.getenv("FAKE_LLM_SEED", "0"))
+        )
+    raise ValueError(f"Unknown LLM_BACKEND '{backend}', expected gemini or fake")
@@ -0,0 +1,99 @@
+"""llm_cache.py"""
+
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """
+    LRU cache of LLM responses keyed by a hash of the model name and prompt.
+    Entries are evicted least recently used first once either max_entries or
+    max_bytes (total length of the cached responses) is exceeded. With a backing
+    file every new entry is appended to it, and load() reloads and compacts it.
+    Safe to use from several threads.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=16 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # {key: response}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.file = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(model, prompt):
+        return hashlib.sha256(f"{model}\0{prompt}".encode()).hexdigest()
+
+    def get(self, model, prompt):
+        """
+        Returns:
+            str: The cached response, or None on a miss.
+        """
+        key = self.key(model, prompt)
+        with self.lock:
+            response = self.entries.get(key)
+            if response is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return response
+
+    def put(self, model, prompt, response):
+        key = self.key(model, prompt)
+        with self.lock:
+            self._insert(key, response)
+            if self.file is not None:
+                self.file.write(json.dumps([key, response]) + "\n")
+                self.file.flush()
+
+    def _insert(self, key, response):
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key))
+        self.entries[key] = response
+        self.size += len(response)
+
+        while self.entries and (len(self.entries) > self.max_entries or self.size > self.max_bytes):
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def load(self, path):
+        """
+        Fill the cache from a backing file and keep appending new entries to it.
+        The file is rewritten with only the entries that survived eviction, so it
+        does not grow past the cache limits across restarts.
+        """
+        with self.lock:
+            if os.path.exists(path):
+                with open(path) as f:
+                    for line in f:
+                        try:
+                            key, response = json.loads(line)
+                        except ValueError:
+                            break  # Torn final line
+                        self._insert(key, response)
+
+            temp_path = f"{path}.tmp"
+            with open(temp_path, "w") as f:
+                for key, response in self.entries.items():
+                    f.write(json.dumps([key, response]) + "\n")
+            os.replace(temp_path, path)
+
+            if self.file is not None:
+                self.file.close()
+            self.file = open(path, "a")
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.entries),
+                "bytes": self.size
+            }
@@ -0,0 +1,117 @@
+"""llm_client.py"""
+
+import time
+import random
+import threading
+
+
+class LLMError(Exception):
+    """Generation failed for good: retries ran out, the error was permanent or the deadline passed."""
+
+
+class TokenBucket:
+    """
+    Rate limiter allowing rate requests per second on average and bursts of up to burst requests.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, deadline):
+        """
+        Take one token, waiting for it to refill if needed.
+        Args:
+            deadline (float): time.monotonic() value after which to give up.
+        Returns:
+            bool: False if no token would be available before the deadline.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait_time = (1 - self.tokens) / self.rate
+
+            if now + wait_time > deadline:
+                return False
+            time.sleep(wait_time)
+
+
+class LLMClient:
+    """
+    Long-lived client in front of an LLM backend, shared by every thread of the process.
+    Limits the calls in progress with a semaphore and the call rate with a token
+    bucket, retries transient failures with exponential backoff and full jitter,
+    and gives up once a request has run for deadline seconds in total.
+    """
+
+    def __init__(self, backend, max_concurrency=4, rate=5.0, burst=5, max_retries=3,
+                 backoff_base=0.5, backoff_max=8.0, deadline=30.0):
+        self.backend = backend
+        self.semaphore = threading.BoundedSemaphore(max_concurrency)
+        self.rate_limiter = TokenBucket(rate, burst)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.deadline = deadline
+
+    @property
+    def name(self):
+        return self.backend.name
+
+    def generate(self, prompt):
+        """
+        Returns:
+            str: The response text.
+        Raises:
+            LLMError: If no response was generated within the deadline and retries.
+        """
+        return "".join(self.stream(prompt))
+
+    def stream(self, prompt):
+        """
+        Yield the response in pieces as the backend generates them. Failures are
+        only retried before the first piece, after that the error is raised.
+        Raises:
+            LLMError: If no response was generated within the deadline and retries.
+        """
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+
+        while True:
+            if not self.rate_limiter.acquire(deadline):
+                raise LLMError(f"deadline of {self.deadline}s reached waiting for the rate limit")
+            if not self.semaphore.acquire(timeout=max(0.0, deadline - time.monotonic())):
+                raise LLMError(f"deadline of {self.deadline}s reached waiting for a free slot")
+
+            started = False
+            try:
+                for piece in self.backend.stream(prompt, timeout=max(0.0, deadline - time.monotonic())):
+                    started = True
+                    yield piece
+                return
+            except Exception as e:
+                error = e
+            finally:
+                self.semaphore.release()
+
+            attempt += 1
+            if started:
+                raise LLMError(f"{error} (after partial output)") from error
+            if not self.backend.is_transient(error):
+                raise LLMError(f"{error}") from error
+            if attempt > self.max_retries:
+                raise LLMError(f"{error} (gave up after {attempt} attempts)") from error
+
+            # Full jitter: sleep a random time up to the exponential backoff
+            backoff = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+            if time.monotonic() + backoff >= deadline:
+                raise LLMError(f"{error} (deadline of {self.deadline}s reached)") from error
+            time.sleep(backoff)
@@ -2,59 +2,215 @@
 
 import sys
 import time
-import socket
-import json
-from shared import message, NETWORK_SERVER_PORT, MAX_SERVER_NUM, DELAY
+import asyncio
+from collections import deque
+from shared import message, NETWORK_SERVER_PORT, MAX_SERVER_NUM, DELAY, FrameReader, FRAME_HEADER, encode_frame
+from relay_metrics import RelayMetrics
+from traffic_trace import TraceWriter
 import threading
 
 # Global Variables
 global server_running
 stop_event = threading.Event()
-lock = threading.Lock()
+relay_loop = None  # asyncio event loop that owns every socket and timer
+
+# Bytes buffered for a single destination before new frames to it are dropped
+OUTBOUND_BUFFER_LIMIT = 4 * 1024 * 1024
 
 socket_info = [
-    [None, None, None],  # Sockets (initially null)
-    [
-        #Link status [Sending][Receiving]
-        [1, 1, 1],  # Status of links from server 1
-        [1, 1, 1],  # Status of links from server 2
-        [1, 1, 1],  # Status of links from server 3
-    ]   
+    [],  # ServerConnections for each server (initially null)
+    [],  # Link status [Sending][Receiving], one row per server
 ]
 
+# Optional flexible phase-2 quorum size, shared with every server
+phase2_quorum = None
+
+# (received_at, message_type, dest_server, sending_server, frame) waiting out their DELAY, in arrival order
+delivery_queue = deque()
+
+# Per-link traffic counters, periodically written to METRICS_FILE
+metrics = RelayMetrics()
+METRICS_FILE = "relay_metrics.prom"
+METRICS_DUMP_INTERVAL = 10
+
+# TraceWriter recording every forwarded frame while capture is on
+trace_writer = None
+
+
+class ServerConnection(asyncio.BufferedProtocol):
+    """
+    One non-blocking connection to a server, driven by the relay event loop.
+    Incoming bytes are received straight into a FrameReader; outgoing frames are
+    handed to the transport, which buffers them so a slow server only backs up
+    its own link.
+    """
+
+    def __init__(self):
+        self.reader = FrameReader()
+        self.transport = None
+        self.server_num = -1
+
+    def __str__(self):
+        peer = self.transport.get_extra_info("peername") if self.transport else None
+        buffered = self.transport.get_write_buffer_size() if self.transport else 0
+        return f"{peer} (buffered={buffered})"
+
+    def connection_made(self, transport):
+        """
+        Pseudocode:
+        - Assign a socket number and store it
+        - Send server initialization confirmation
+        """
+        self.transport = transport
+        addr = transport.get_extra_info("peername")
+
+        #Add connection to first available socket in socket_info, growing the cluster only when every slot is in use
+        if None not in socket_info[0]:
+            grow_socket_info()
+
+        count = socket_info[0].index(None)
+        socket_info[0][count] = self
+        self.server_num = count
+        print(f"Accepted connection from {addr} as Server {count}")
+
+        #Delay to enable server to setup message_handling
+        relay_loop.call_later(0.1, self.send_init)
+
+    def send_init(self):
+        #Send Server Server_Init message with ServerNum
+        message_data = {
+            "dest_server": -1,
+            "sending_server": -1,
+            "message_type": message.SERVER_INIT.value,
+            "args": {
+                "server_num": self.server_num,
+                "cluster_size": len(socket_info[0]),
+                "phase2_quorum": phase2_quorum
+            }
+        }
+        self.send(encode_frame(message_data))
+
+    def get_buffer(self, sizehint):
+        return self.reader.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        self.reader.buffer_updated(nbytes)
+        received_at = relay_loop.time()
+        for message_type, dest_server, sending_server, frame in self.reader.routed_frames():
+            schedule_server_message(message_type, dest_server, sending_server, frame, received_at)
+
+    def connection_lost(self, exc):
+        print("Server Disconnected")
+
+        #Free the server's slot so a restarted server takes its number back instead of growing the cluster
+        if 0 <= self.server_num < len(socket_info[0]) and socket_info[0][self.server_num] is self:
+            socket_info[0][self.server_num] = None
+
+    def send(self, frame):
+        """
+        Queue a frame on this link without blocking.
+        Returns:
+            bool: False if the link is closed or over its buffer limit and the frame was dropped.
+        """
+        if self.transport.is_closing():
+            return False
+        if self.transport.get_write_buffer_size() > OUTBOUND_BUFFER_LIMIT:
+            print(f"Outbound buffer full to Server {self.server_num}, dropping frame")
+            return False
+        self.transport.write(frame)
+        return True
+
+    def close_when_sent(self):
+        """
+        Close the connection once every frame already queued has been written.
+        """
+        self.transport.close()
+
+    def close(self):
+        """
+        Close the connection immediately, discarding anything still buffered.
+        """
+        self.transport.abort()
+
+
 # Setup socket information data structure
-def setup_socket_info():
+def setup_socket_info(cluster_size):
     """
     Pseudocode:
-    - Initialize socket_info 2D array
-    - Set all sockets to None initially
+    - Initialize socket_info 2D array for cluster_size servers
+    - Set all sockets to None initially and all links to 1
     """
+    socket_info[0] = [None] * cluster_size
+    socket_info[1] = [[1] * cluster_size for _ in range(cluster_size)]
+
+def grow_socket_info():
+    """
+    Pseudocode:
+    - Add a socket slot and a row/column of working links for a new server
+    - Tell every connected server the new cluster size so quorums are recomputed
+    """
+    for row in socket_info[1]:
+        row.append(1)
+    socket_info[0].append(None)
+    socket_info[1].append([1] * len(socket_info[0]))
+
+    cluster_size = len(socket_info[0])
+    print(f"Cluster grown to {cluster_size} servers")
+
+    message_data = {
+        "dest_server": -1,
+        "sending_server": -1,
+        "message_type": message.CLUSTER_UPDATE.value,
+        "args": {
+            "cluster_size": cluster_size,
+            "phase2_quorum": phase2_quorum
+        }
+    }
+    frame = encode_frame(message_data)
+    for soc in socket_info[0]:
+        if soc is not None:
+            soc.send(frame)
 
 # Simulate user input for server control
 def get_user_input():
     """
     Pseudocode:
     - Continuously accept user input in a loop
-    - Handle commands like fail_link, fix_link, fail_Node, etc.
+    - Hand each command to the relay event loop, which owns all link state
     """
     while not stop_event.is_set():
         user_input = input() # Input message from the user
+        relay_loop.call_soon_threadsafe(handle_user_input, user_input)
         if user_input.lower() == 'exit':
-            stop_event.set()
-            for soc in socket_info[0]:
-                if soc != None:
-                    soc.close()
             break
-        elif user_input.startswith("failLink"):
-            fail_link(user_input)
-        elif user_input.startswith("fixLink"):
-            fix_link(user_input)
-        elif user_input.startswith("failNode"):
-            fail_node(user_input)
-        elif user_input.startswith("status"):
-            print_socket_status()
-        else:
-            print(f"UNCRECOGNIZED INPUT {user_input}")
+
+def handle_user_input(user_input):
+    """
+    Pseudocode:
+    - Handle commands like fail_link, fix_link, fail_Node, etc.
+    - Runs on the relay event loop
+    """
+    if user_input.lower() == 'exit':
+        stop_event.set()
+        if trace_writer is not None:
+            trace_writer.close()
+        for soc in socket_info[0]:
+            if soc != None:
+                soc.close()
+    elif user_input.startswith("failLink"):
+        fail_link(user_input)
+    elif user_input.startswith("fixLink"):
+        fix_link(user_input)
+    elif user_input.startswith("failNode"):
+        fail_node(user_input)
+    elif user_input.startswith("status"):
+        print_socket_status()
+    elif user_input.startswith("stats"):
+        print(metrics.format_table(len(delivery_queue), buffered_bytes()))
+    elif user_input.startswith("capture"):
+        capture(user_input)
+    else:
+        print(f"UNCRECOGNIZED INPUT {user_input}")
 
 # Fail a link between two servers
 def fail_link(user_message):
@@ -93,6 +249,7 @@ def fix_link(user_message):
     print(f"Fixed Link src={result[0]}, dest={result[1]}")
 
 def print_socket_status():
+    print(f"Delivery Queue Depth: {len(delivery_queue)}")
     print("Sockets:")
     # Print socket information
     for i, soc in enumerate(socket_info[0], start=1):
@@ -108,6 +265,46 @@ def print_socket_status():
         print(f"S{i}: {row_status}")
 
 
+def capture(user_message):
+    """
+    Pseudocode:
+    - "capture <path>" starts appending every frame the relay delivers to the trace file at path
+    - "capture stop" stops recording and closes the trace file
+    """
+    global trace_writer
+    parts = user_message.split()
+    if len(parts) != 2:
+        print("Error: Invalid message format. Use: capture <path> or capture stop")
+        return
+
+    if trace_writer is not None:
+        trace_writer.close()
+        print(f"Stopped capture to {trace_writer.path} after {trace_writer.records} frames")
+        trace_writer = None
+
+    if parts[1] != "stop":
+        trace_writer = TraceWriter(parts[1])
+        print(f"Capturing traffic to {parts[1]}")
+
+def buffered_bytes():
+    """
+    Bytes waiting in each connected server's write buffer
+    """
+    return {count: soc.transport.get_write_buffer_size() for count, soc in enumerate(socket_info[0]) if soc is not None}
+
+def dump_metrics():
+    """
+    Write the metrics exposition to METRICS_FILE and schedule the next dump
+    """
+    try:
+        metrics.dump(METRICS_FILE, len(delivery_queue), buffered_bytes())
+        if trace_writer is not None:
+            trace_writer.flush()
+    except OSError as e:
+        print(f"FAILED WRITING METRICS: {e}")
+    relay_loop.call_later(METRICS_DUMP_INTERVAL, dump_metrics)
+
+
 def decode_link_user_message(user_message):
     """
     Helper message to deconde link
@@ -129,8 +326,9 @@ def decode_link_user_message(user_message):
     # Validate src and dest
     if src == dest:
         return False, "Source and destination cannot be the same."
-    if not (0 <= src <= MAX_SERVER_NUM and 0 <= dest <= MAX_SERVER_NUM):
-        return False, f"Source and destination must be between 0 and {MAX_SERVER_NUM}."
+    cluster_size = len(socket_info[0])
+    if not (0 <= src < cluster_size and 0 <= dest < cluster_size):
+        return False, f"Source and destination must be between 0 and {cluster_size - 1}."
     
     return True, (src, dest)
     
@@ -143,155 +341,118 @@ def fail_node(user_message):
     - Set all links to/from the node to 0 (inactive) in socket_info[1]
     """
     _, dest_server = user_message.split()
+    dest_server = int(dest_server)
 
     message_data = {
-        "dest_server": int(dest_server),
+        "dest_server": dest_server,
         "sending_server": -1,
         "message_type": message.SERVER_KILL.value,
     }
     
-    server_message = json.dumps(message_data)
-    forward_server_message(server_message)
+    forward_server_message(message.SERVER_KILL.value, dest_server, -1, encode_frame(message_data), relay_loop.time())
     
 # Start the server and listen for connections
-def run_server():
+async def run_server():
     """
     Dakota
     Pseudocode:
-    - Setup server and port
-    - While server is running:
-        - Accept incoming connections
-        - Assign a socket number and store it
-        - Send server initialization confirmation
+    - Setup server and port on the relay event loop
+    - Connections are accepted and served by ServerConnection
+    - Run until the user exits
     """
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM) # Create a TCP socket
-    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server.bind(('0.0.0.0', NETWORK_SERVER_PORT))  # Bind to all interfaces
-    server.listen(5) # Start listening for connections
-    server.settimeout(1)  # Set a timeout of 1 second for accepting connections
+    global relay_loop
+    relay_loop = asyncio.get_running_loop()
+
+    server = await relay_loop.create_server(
+        ServerConnection, '0.0.0.0', NETWORK_SERVER_PORT, reuse_address=True  # Bind to all interfaces
+    )
     print(f"Server started on port {NETWORK_SERVER_PORT}")
 
-    while not stop_event.is_set():
-        try:
-            
-            server_socket, addr = server.accept() # Accept client connections
-
-            #Add connected socket to first available socket in socket_info
-            for count, soc in enumerate(socket_info[0]):
-                if soc is None:
-                    # Add socket to socket_info at the correct index
-                    socket_info[0][count] = server_socket
-                    print(f"Accepted connection from {addr} as Server {count}")
-                    #Sleep to enable server to setup message_handling
-                    time.sleep(0.1)
-                    
-                    #Send Server Server_Init message with ServerNum
-                    message_data = {
-                        "dest_server": -1,
-                        "sending_server": -1,
-                        "message_type": message.SERVER_INIT.value,
-                        "args": {
-                            "server_num": count
-                        }
-                    }
-                    
-                    # Serialize to JSON
-                    serialized_message = json.dumps(message_data)
-                    server_socket.send(serialized_message.encode('utf-8'))  # Convert JSON string to bytes
-
-                    break
-
-            # Create a new thread
-            server_handler = threading.Thread(target=get_server_message,args=(server_socket,))
-            server_handler.start() # Start the new thread            
-           
-        except socket.timeout:
-            #Timeout enabled so that will be nonblocking
-            continue
-
-def get_server_message(server):
-    """
-    Continuously receive and buffer messages from a server.
-    Ensure fragmented messages are reassembled before processing.
-    """
-    buffer = ""  # Buffer to store incomplete messages
+    relay_loop.call_later(METRICS_DUMP_INTERVAL, dump_metrics)
+    threading.Thread(target=get_user_input, daemon=True).start()
 
     while not stop_event.is_set():
-        try:
-            # Receive data in chunks
-            data = server.recv(1024).decode('utf-8')
-            if not data:
-                raise socket.error()
-            
-            buffer += data  # Append received data to the buffer
-
-            while True:
-                try:
-                    # Attempt to parse a complete JSON object
-                    message_data, end_idx = json.JSONDecoder().raw_decode(buffer)
-                    buffer = buffer[end_idx:].strip()  # Remove processed message from buffer
-
-                    # Process the complete message in a separate thread
-                    threading.Thread(target=forward_server_message, args=(json.dumps(message_data),)).start()
-                except json.JSONDecodeError:
-                    # If parsing fails, wait for more data
-                    break
-
-        except socket.error:
-            print("Server Disconnected")
-            break
-            #continue
+        await asyncio.sleep(0.5)
+
+    server.close()
+
+def schedule_server_message(message_type, dest_server, sending_server, frame, received_at):
+    """
+    Hold a received frame for DELAY seconds before forwarding it.
+    Every frame waits the same DELAY, so each timer forwards the oldest queued
+    frame and links stay FIFO. Kill commands are forwarded immediately.
+    """
+    if message_type == message.SERVER_KILL.value:
+        forward_server_message(message_type, dest_server, sending_server, frame, received_at)
+    else:
+        delivery_queue.append((received_at, message_type, dest_server, sending_server, frame))
+        relay_loop.call_later(DELAY, forward_next_message)
+
+def forward_next_message():
+    received_at, message_type, dest_server, sending_server, frame = delivery_queue.popleft()
+    forward_server_message(message_type, dest_server, sending_server, frame, received_at)
 
 # Forward messages to appropriate destinations
-def forward_server_message(server_message):
+def forward_server_message(message_type, dest_server_num, sending_server, frame, received_at):
     """
     Dakota
+    Called on the relay event loop once the message's DELAY has elapsed.
+    Routing uses only the frame header; the original frame bytes are forwarded untouched.
     Pseudocode:
     - Check destination server status
     - If dest_server == -1, forward to all except origin_server
     - Otherwise, forward to the specified destination
-    Message format <destination server> <rest of message>
     """
-    #Get Json Datastructure from message
-    message_data = json.loads(server_message)
-    message_type = message_data["message_type"]
-
-    #Delay for required time period (if not kill command)
-    if message_type != message.SERVER_KILL.value:
-        time.sleep(DELAY)
-
     try:
-        #Lock to protect prints and sending messages
-        with lock:
-
-            #Determine destination server number from message_data
-            dest_server_num = message_data["dest_server"]
-            sending_server = message_data["sending_server"]
+        #if server number is -1 send message to all except sender
+        if dest_server_num == -1:
+            dests = [count for count in range(len(socket_info[0])) if count != sending_server]
             
-            #if server number is -1 send message to all except sender
-            if dest_server_num == -1:
-                for count, soc in enumerate(socket_info[0]):
-                    if count != sending_server and check_forward_connection(socket_info[0][sending_server], soc, sending_server, count, message_type):
-                        soc.send(server_message.encode('utf-8'))
-                
-            #else send to specific server_num
+        #else send to specific server_num
+        else:
+            dests = [dest_server_num]
+        delivered = [dest for dest in dests if forward_to(sending_server, dest, frame, message_type, received_at)]
+
+        #Record the frame exactly as relayed when capturing traffic, only towards the servers it reached
+        if trace_writer is not None and delivered:
+            payload = memoryview(frame)[FRAME_HEADER.size:]
+            if dest_server_num == -1 and len(delivered) == len(dests):
+                trace_writer.write(time.time(), sending_server, -1, message_type, payload)
             else:
-                #Get socket from socket_info and server_num
-                dest_server = socket_info[0][dest_server_num]
-                if check_forward_connection(socket_info[0][sending_server], dest_server, sending_server, dest_server_num, message_type):
-                    dest_server.send(server_message.encode('utf-8'))
+                for dest in delivered:
+                    trace_writer.write(time.time(), sending_server, dest, message_type, payload)
 
-            #If sending Kill message close connection to server
-            if message_type is message.SERVER_KILL.value:
-                #print(f"Failed Node {dest_server_num}")
-                socket_info[0][dest_server_num].close()
-                socket_info[0][dest_server_num] = None
+        #If sending Kill message close connection to server once the kill is written
+        if message_type is message.SERVER_KILL.value:
+            #print(f"Failed Node {dest_server_num}")
+            socket_info[0][dest_server_num].close_when_sent()
+            socket_info[0][dest_server_num] = None
 
     except Exception as e:
         # Print the error along with the message that caused it
-        print(f"FAILED FORWARDING MESSAGE: {server_message}")
+        print(f"FAILED FORWARDING MESSAGE: {message(message_type)} from {sending_server} to {dest_server_num}")
         print(f"ERROR: {e}")
 
+def forward_to(sending_server, dest_server_num, frame, message_type, received_at):
+    """
+    Send frame over a single link and record the outcome in metrics
+    Returns:
+        bool: True if the frame was handed to the destination's connection.
+    """
+    src_soc = socket_info[0][sending_server]
+    dest_soc = socket_info[0][dest_server_num]
+
+    if not check_forward_connection(src_soc, dest_soc, sending_server, dest_server_num, message_type):
+        reason = "node" if src_soc is None or dest_soc is None else "link"
+        metrics.record_dropped(sending_server, dest_server_num, message_type, len(frame), reason)
+        return False
+    elif not dest_soc.send(frame):
+        metrics.record_dropped(sending_server, dest_server_num, message_type, len(frame), "buffer")
+        return False
+    else:
+        metrics.record_forwarded(sending_server, dest_server_num, message_type, len(frame), relay_loop.time() - received_at)
+        return True
+
 def check_forward_connection(src_soc, dest_soc, src, dest, message_type):
     
     #Handle Case when sending Kill message directly from Network Server
@@ -316,12 +477,14 @@ def check_forward_connection(src_soc, dest_soc, src, dest, message_type):
 
 if __name__ == "__main__":
     print("Network Server")
-    setup_socket_info()
-    threading.Thread(target=run_server).start()
-    threading.Thread(target=get_user_input).start()
 
-    while not stop_event.is_set():
-        time.sleep(0.5)
+    # Usage: python3 network_server.py [cluster_size] [phase2_quorum]
+    cluster_size = int(sys.argv[1]) if len(sys.argv) > 1 else MAX_SERVER_NUM
+    if len(sys.argv) > 2:
+        phase2_quorum = int(sys.argv[2])
+
+    setup_socket_info(cluster_size)
+    asyncio.run(run_server())
 
     sys.stdout.flush()
-    sys.exit(0)
\ No newline at end of file
+    sys.exit(0)
@@ -0,0 +1,142 @@
+"""relay_metrics.py"""
+
+import os
+import bisect
+from shared import message, DELAY
+
+# Upper bounds (seconds) of the receive-to-send latency histogram buckets. Every
+# relayed frame waits DELAY, so most buckets sit just above it to show the queueing
+# on top of the delay; the small ones catch frames forwarded without it (kills).
+LATENCY_BUCKETS = tuple(sorted({
+    0.001, 0.005, 0.01, 0.05, 0.1,
+    round(float(DELAY), 6), round(DELAY + 0.01, 6), round(DELAY + 0.1, 6), round(DELAY + 0.5, 6),
+    round(DELAY * 1.5 + 0.5, 6), round(DELAY * 3 + 1.0, 6)
+}))
+
+
+class LatencyHistogram:
+    """Cumulative-style latency histogram with fixed bucket bounds."""
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)  # Last bucket is +Inf
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def cumulative(self):
+        """
+        Returns:
+            list: (upper bound label, cumulative count) pairs ending with +Inf.
+        """
+        result = []
+        running = 0
+        for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), self.counts):
+            running += count
+            result.append((str(bound), running))
+        return result
+
+
+class RelayMetrics:
+    """
+    Counters for traffic through the network server.
+    Messages and bytes are counted per (src, dest, message type, outcome), and a
+    latency histogram per (src, dest) link records the time from receiving a
+    frame to handing it to the destination socket.
+    All updates happen on the relay event loop, so no locking is needed.
+    """
+
+    def __init__(self):
+        # {(src, dest, type_name, outcome): [messages, bytes]}
+        self.counters = {}
+        # {(src, dest): LatencyHistogram}
+        self.latency = {}
+
+    def record_forwarded(self, src, dest, message_type, nbytes, latency):
+        self._count(src, dest, message_type, "forwarded", nbytes)
+        link = (src, dest)
+        if link not in self.latency:
+            self.latency[link] = LatencyHistogram()
+        self.latency[link].observe(latency)
+
+    def record_dropped(self, src, dest, message_type, nbytes, reason):
+        self._count(src, dest, message_type, f"dropped_{reason}", nbytes)
+
+    def _count(self, src, dest, message_type, outcome, nbytes):
+        key = (src, dest, message(message_type).name, outcome)
+        entry = self.counters.setdefault(key, [0, 0])
+        entry[0] += 1
+        entry[1] += nbytes
+
+    def format_table(self, queue_depth, buffered):
+        """
+        Build a human readable summary for the `stats` command.
+        Args:
+            queue_depth (int): Messages waiting out their DELAY.
+            buffered (dict): {server_num: bytes waiting in that link's write buffer}.
+        Returns:
+            str: The formatted statistics.
+        """
+        lines = [f"Delivery Queue Depth: {queue_depth}"]
+        lines.append("Outbound Buffered Bytes: " + ", ".join(f"S{num}={size}" for num, size in sorted(buffered.items())))
+
+        lines.append("\nLink      Type            Outcome             Messages       Bytes")
+        for (src, dest, type_name, outcome), (count, nbytes) in sorted(self.counters.items()):
+            lines.append(f"S{src}->S{dest:<4} {type_name:<15} {outcome:<18} {count:>9} {nbytes:>11}")
+
+        lines.append("\nLink      Forwarded   Avg Latency(s)")
+        for (src, dest), histogram in sorted(self.latency.items()):
+            average = histogram.total / histogram.count if histogram.count else 0.0
+            lines.append(f"S{src}->S{dest:<4} {histogram.count:>9}   {average:.4f}")
+        return "\n".join(lines)
+
+    def exposition(self, queue_depth, buffered):
+        """
+        Render every metric in the Prometheus text exposition format.
+        """
+        lines = [
+            "# HELP relay_messages_total Messages handled by the relay per link, type and outcome.",
+            "# TYPE relay_messages_total counter",
+        ]
+        for (src, dest, type_name, outcome), (count, _) in sorted(self.counters.items()):
+            lines.append(f'relay_messages_total{{src="{src}",dest="{dest}",type="{type_name}",outcome="{outcome}"}} {count}')
+
+        lines += [
+            "# HELP relay_bytes_total Bytes handled by the relay per link, type and outcome.",
+            "# TYPE relay_bytes_total counter",
+        ]
+        for (src, dest, type_name, outcome), (_, nbytes) in sorted(self.counters.items()):
+            lines.append(f'relay_bytes_total{{src="{src}",dest="{dest}",type="{type_name}",outcome="{outcome}"}} {nbytes}')
+
+        lines += [
+            "# HELP relay_forward_latency_seconds Time from receiving a frame to writing it to the destination.",
+            "# TYPE relay_forward_latency_seconds histogram",
+        ]
+        for (src, dest), histogram in sorted(self.latency.items()):
+            for bound, count in histogram.cumulative():
+                lines.append(f'relay_forward_latency_seconds_bucket{{src="{src}",dest="{dest}",le="{bound}"}} {count}')
+            lines.append(f'relay_forward_latency_seconds_sum{{src="{src}",dest="{dest}"}} {histogram.total}')
+            lines.append(f'relay_forward_latency_seconds_count{{src="{src}",dest="{dest}"}} {histogram.count}')
+
+        lines += [
+            "# HELP relay_delivery_queue_depth Messages waiting out their DELAY.",
+            "# TYPE relay_delivery_queue_depth gauge",
+            f"relay_delivery_queue_depth {queue_depth}",
+            "# HELP relay_outbound_buffered_bytes Bytes waiting in a link's write buffer.",
+            "# TYPE relay_outbound_buffered_bytes gauge",
+        ]
+        for num, size in sorted(buffered.items()):
+            lines.append(f'relay_outbound_buffered_bytes{{dest="{num}"}} {size}')
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path, queue_depth, buffered):
+        """
+        Atomically replace the file at path with the current exposition.
+        """
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w") as f:
+            f.write(self.exposition(queue_depth, buffered))
+        os.replace(temp_path, path)
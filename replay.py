@@ -0,0 +1,165 @@
+# replay.py
+"""
+Replay traffic recorded with the network server's `capture <path>` command.
+
+Usage:
+    python3 replay.py <trace> [--mode relay|server] [--server-num N] [--speed 1|N|max]
+
+relay:  Connect to a running network server once for every replica seen in the
+        trace and send each recorded frame from its original sender. Use this to
+        benchmark the relay itself.
+server: Stand in for the network server. Wait for one server.py process to
+        connect, assign it --server-num and deliver every frame the trace shows
+        reaching that server. Use this to benchmark a replica against real traffic.
+"""
+
+import sys
+import time
+import json
+import socket
+import argparse
+import threading
+from shared import message, NETWORK_SERVER_PORT, DELAY, FrameReader, encode_frame, pack_frame
+from traffic_trace import read_trace
+
+
+def paced(records, speed):
+    """
+    Yield records at their recorded spacing divided by speed (None = as fast as possible).
+    """
+    start = time.monotonic()
+    first_timestamp = None
+    for record in records:
+        if speed is not None:
+            if first_timestamp is None:
+                first_timestamp = record[0]
+            wait_time = start + (record[0] - first_timestamp) / speed - time.monotonic()
+            if wait_time > 0:
+                time.sleep(wait_time)
+        yield record
+
+
+def drain(sock, counter):
+    """
+    Read and discard everything a peer sends, counting frames and bytes.
+    """
+    reader = FrameReader()
+    try:
+        while reader.recv_from(sock):
+            for _, payload in reader.frames():
+                counter[0] += 1
+                counter[1] += len(payload)
+    except OSError:
+        pass
+
+
+def replay_through_relay(path, speed, port):
+    """
+    Impersonate every sender in the trace and push its frames through the relay.
+    """
+    num_senders = max((src for _, src, _, _, _ in read_trace(path)), default=-1) + 1
+    connections = {}
+    received = [0, 0]
+
+    # Connect one at a time so the relay assigns server numbers in order
+    for _ in range(num_senders):
+        sock = socket.create_connection(('127.0.0.1', port))
+        reader = FrameReader()
+        server_num = None
+        while server_num is None and reader.recv_from(sock):
+            for message_type, payload in reader.frames():
+                if message_type == message.SERVER_INIT.value:
+                    server_num = json.loads(payload)["args"]["server_num"]
+        connections[server_num] = sock
+        threading.Thread(target=drain, args=(sock, received), daemon=True).start()
+
+    missing = [num for num in range(num_senders) if num not in connections]
+    if missing:
+        print(f"WARNING: relay did not assign server numbers {missing}, their frames will be skipped")
+
+    sent, sent_bytes = 0, 0
+    start = time.monotonic()
+    for _, src, dest, message_type, payload in paced(read_trace(path), speed):
+        # Frames originating at the network server itself (e.g. SERVER_KILL) are not replayed
+        if src not in connections:
+            continue
+        connections[src].sendall(pack_frame(message_type, dest, src, payload))
+        sent += 1
+        sent_bytes += len(payload)
+    elapsed = time.monotonic() - start
+
+    # Let the relay finish delivering the last frames before reporting
+    time.sleep(DELAY + 1)
+    report(sent, sent_bytes, elapsed)
+    print(f"Received {received[0]} frames ({received[1]} bytes) back from the relay")
+    for sock in connections.values():
+        sock.close()
+
+
+def replay_into_server(path, speed, port, server_num):
+    """
+    Act as the network server for one server.py process and feed it its traffic.
+    """
+    records = list(read_trace(path))
+    cluster_size = max([server_num] + [max(src, dest) for _, src, dest, _, _ in records]) + 1
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('0.0.0.0', port))
+    listener.listen(1)
+    print(f"Waiting for server.py to connect on port {port}")
+    sock, addr = listener.accept()
+    print(f"Replaying to {addr} as Server {server_num}")
+
+    received = [0, 0]
+    threading.Thread(target=drain, args=(sock, received), daemon=True).start()
+    sock.sendall(encode_frame({
+        "dest_server": -1,
+        "sending_server": -1,
+        "message_type": message.SERVER_INIT.value,
+        "args": {
+            "server_num": server_num,
+            "cluster_size": cluster_size,
+            "phase2_quorum": None
+        }
+    }))
+
+    # Only frames the relay would have delivered to server_num
+    delivered = [record for record in records
+                 if record[2] == server_num or (record[2] == -1 and record[1] != server_num)]
+
+    sent, sent_bytes = 0, 0
+    start = time.monotonic()
+    for _, src, dest, message_type, payload in paced(delivered, speed):
+        sock.sendall(pack_frame(message_type, dest, src, payload))
+        sent += 1
+        sent_bytes += len(payload)
+    elapsed = time.monotonic() - start
+
+    time.sleep(1)
+    report(sent, sent_bytes, elapsed)
+    print(f"Received {received[0]} frames ({received[1]} bytes) from the server")
+    sock.close()
+    listener.close()
+
+
+def report(sent, sent_bytes, elapsed):
+    rate = sent / elapsed if elapsed > 0 else float("inf")
+    print(f"Replayed {sent} frames ({sent_bytes} bytes) in {elapsed:.3f}s ({rate:.1f} frames/s)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a captured relay traffic trace")
+    parser.add_argument("trace", help="Trace file written by the network server's capture command")
+    parser.add_argument("--mode", choices=["relay", "server"], default="relay")
+    parser.add_argument("--server-num", type=int, default=0, help="Server number to impersonate the relay for (server mode)")
+    parser.add_argument("--speed", default="1", help="Replay speed multiplier, or 'max' for no pacing")
+    parser.add_argument("--port", type=int, default=NETWORK_SERVER_PORT)
+    args = parser.parse_args()
+
+    speed = None if args.speed == "max" else float(args.speed)
+    if args.mode == "relay":
+        replay_through_relay(args.trace, speed, args.port)
+    else:
+        replay_into_server(args.trace, speed, args.port, args.server_num)
+    sys.exit(0)
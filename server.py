@@ -8,43 +8,162 @@ import os
 import json
 import select
 import copy
-import google.generativeai as genai
-from dotenv import load_dotenv
+import zlib
+import hashlib
+import base64
+import itertools
 from queue import Queue
-from shared import message, NETWORK_SERVER_PORT, MAX_SERVER_NUM, DELAY, TIMEOUT_TIME
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from shared import message, NETWORK_SERVER_PORT, MAX_SERVER_NUM, DELAY, TIMEOUT_TIME, DECIDE_TIMEOUT, PIPELINE_WINDOW, BATCH_MAX_OPS, BATCH_MAX_BYTES, LOG_RETENTION, REQUEST_ID_RETENTION, DATA_DIR, NUM_CONSENSUS_GROUPS, SNAPSHOT_INTERVAL_OPS, SNAPSHOT_INTERVAL_BYTES, SNAPSHOT_CHUNK_BYTES, SNAPSHOT_CHUNK_INTERVAL, LLM_WORKERS, LLM_CACHE_MAX_ENTRIES, LLM_CACHE_MAX_BYTES, LLM_CACHE_PERSIST, LLM_MAX_CONCURRENCY, LLM_RATE_LIMIT, LLM_RATE_BURST, LLM_MAX_RETRIES, LLM_BACKOFF_BASE, LLM_BACKOFF_MAX, LLM_DEADLINE, LLM_STREAM, PROMPT_BUDGET_CHARS, PROMPT_SUMMARY_CHARS, FrameReader, send_frame, quorum_sizes
 
 from key_value import KeyValue
+from llm_cache import ResponseCache
+from llm_backend import create_backend
+from llm_client import LLMClient, LLMError
+from wal import WriteAheadLog, read_wal, list_segments, write_snapshot, read_snapshot
 
 
-keyValue = KeyValue()
 networkServer = None
+send_lock = threading.Lock()  # Keeps frames sent from different threads from interleaving
 stop_event = threading.Event()
 SERVER_NUM = -1
+START_TIME = int(time.time() * 1000)  # Tells apart the request IDs of a server that restarted with the same number
 
-# Consensus Variables
-leader = -1
+# Cluster size and quorum sizes (counting this server), updated by SERVER_INIT and CLUSTER_UPDATE
+cluster_size = MAX_SERVER_NUM
+phase1_quorum, phase2_quorum = quorum_sizes(cluster_size)
 
-# Represent the maxmimum known ballot by this server
-ballot_number = {
-    'seq_num': 0,
-    'pid': -1,
-    'op_num': 0
-}
 
-# Server's last accepted value (or leader's current command)
-accept_val = -1
+class ConsensusGroup:
+    """
+    One independent Multi-Paxos instance owning the contexts that hash to it.
+    Each group has its own contexts, ballot, log, leader and pending queue, so
+    operations on contexts of different groups are ordered, batched and decided
+    in parallel, possibly by different leaders. Consensus messages carry the
+    group they belong to in args["group"].
+    """
+
+    def __init__(self, group_id):
+        self.group_id = group_id
+
+        # Contexts of this group
+        self.keyValue = KeyValue()
+
+        # Write-ahead log of promised ballots, accepted values and decided values, opened after replay on SERVER_INIT
+        self.wal = None
+        self.server_dir = None
+
+        # Snapshot being received in SNAPSHOT_CHUNK messages, format = {"transfer_id", "next_index", "last_chunk_time", "staging": KeyValue}
+        self.snapshot_transfer = None
+
+        # Threads streaming a snapshot to a lagging server, format = {dest_server: thread}
+        self.snapshot_senders = {}
+
+        # op_num of the latest snapshot and the thread writing a snapshot, if any
+        self.last_snapshot_op_num = 0
+        self.snapshot_thread = None
+
+        # Consensus Variables
+        self.leader = -1
+
+        # Represent the maxmimum known ballot by this server
+        self.ballot_number = {
+            'seq_num': 0,
+            'pid': -1,
+            'op_num': 0
+        }
+
+        # Values this server accepted but has not yet seen decided, by slot (op_num)
+        # format = {slot: {"accept_num": ballot, "accept_val": value}}
+        self.accepted_slots = {}
+
+        # Decided values waiting for an earlier slot to be decided before they are applied, format = {slot: value}
+        self.decided_slots = {}
+
+        # Request IDs of the last REQUEST_ID_RETENTION operations applied, so an operation proposed
+        # more than once (re-proposed by a new leader and resubmitted by its server) is applied once
+        # format = {request_id: slot}
+        self.decided_requests = OrderedDict()
+
+        # The last LOG_RETENTION applied slots, used to catch up lagging servers without a full snapshot
+        # format = {slot: value}, always the contiguous slots just below ballot_number["op_num"]
+        self.decided_log = OrderedDict()
+
+        # Leader only: slots proposed and not yet decided, format = {slot: (ballot, value, send_time)}
+        self.inflight_slots = {}
+
+        # Leader only: highest-ballot accepted values reported in promises, format = {slot: (accept_num, accept_val)}
+        self.recovered_slots = {}
+
+        #Used for operations
+        self.pending_operations = Queue()
+        self.num_leader_promises = 0
+        self.consensus_accepted = {}
+
+        # Guards the counters above and wakes the election and leader loops the moment
+        # a promise, an accepted reply, a new operation, a new ballot or a stop arrives
+        self.consensus_condition = threading.Condition()
+        self.election_lock = threading.RLock()
+
+        # Serializes applying decisions, catch-up and snapshot installs, which run on both the
+        # receive thread and the leader thread, over decided_slots, decided_log and op_num
+        self.apply_lock = threading.RLock()
 
-# Ballot of server's last accepted value (leader's current ballot)
-accept_num = -1
+        # (op_num, time) of the last CATCH_UP sent, so a gap is asked for once per TIMEOUT_TIME
+        self.catch_up_request = None
 
-#Used for operations
-pending_operations = Queue()
-num_leader_promises = 0
-consensus_accepted = {}
-leader_ack = 0
+
+# Contexts are partitioned over NUM_CONSENSUS_GROUPS groups by a hash of their ID
+groups = [ConsensusGroup(group_id) for group_id in range(NUM_CONSENSUS_GROUPS)]
+
+def context_group(context_id):
+    """
+    Returns:
+        ConsensusGroup: The group that orders the operations on context_id.
+    """
+    # Not crc32 like KeyValue's shards: the contexts of one group would then share a few of its shards
+    context_hash = int.from_bytes(hashlib.blake2b(context_id.encode(), digest_size=4).digest(), "big")
+    return groups[context_hash % len(groups)]
+
+def operation_group(user_message):
+    """
+    Returns:
+        ConsensusGroup: The group of the context a create, query or choose operation is on.
+    """
+    if user_message.startswith("create"):
+        return context_group(user_message.replace("create", "").strip())
+    parts = user_message.split(" ", 2)
+    return context_group(parts[1].strip() if len(parts) > 1 else "")
+
+# Operations this server submitted that are not yet decided, format = {request_id: ConsensusRequest}
+outstanding_requests = {}
+requests_lock = threading.Lock()
+
+# Numbers the operations this server submits, request_id = "<SERVER_NUM>.<start time>.<number>"
+request_numbers = itertools.count()
 
 #Used for Storing responses format = {tuple(context_id, query), list(responses)}
 response_dict = {}
+response_lock = threading.Lock()  # Responses arrive from the LLM pool and the receive thread
+
+# Candidates being streamed in, format = {(context_id, candidate_id): {"index", "next_chunk", "pending": {chunk_index: (text, final)}}}
+streaming_candidates = {}
+
+# Candidates cut off by an LLM error, shown but never chosen, format = {(context_id, candidate_num)}
+truncated_candidates = set()
+
+# The query this server asked last in each context, only its candidates are collected, format = {context_id: query_string}
+current_queries = {}
+
+# Numbers the candidates this server generates, candidate_id = "<SERVER_NUM>.<number>"
+candidate_numbers = itertools.count()
+
+# Generates responses for decided queries, off the threads that run consensus
+llm_pool = ThreadPoolExecutor(max_workers=LLM_WORKERS, thread_name_prefix="llm")
+
+# Responses for prompts this server already sent to the LLM
+response_cache = ResponseCache(LLM_CACHE_MAX_ENTRIES, LLM_CACHE_MAX_BYTES)
 
 
 # ------  SERVER  ------
@@ -55,7 +174,7 @@ def connect_server():
     Receive initial message from server (expecting SERVER_INIT <num>).
     Parse message to retrieve server number and assign to SERVER_NUM.
     Start listening for incoming messages by calling get_server_message().
-    TODO: Implement a method to restore context/kv data in case of a crash.
+    Context/kv data lost in a crash is restored from the WAL once SERVER_INIT arrives.
     """
     global networkServer
 
@@ -80,12 +199,13 @@ def connect_server():
                 print(f"FAILED To Connect to Network Server on {NETWORK_SERVER_PORT}")
                 break
     
-def send_server_message(message_type, dest_server, message_args=None):
+def send_server_message(message_type, dest_server, message_args=None, group=None):
     """
     Dakota
     Send a message to the specified server with a given message type and arguments.
     Format message as <destination_server> <SERVER_NUM> <message_type> <args>.
     Use networkServer to send the formatted message.
+    Consensus messages of a group carry its group_id in args["group"].
     """
     # Create uniform message datastructure
     message_data = {
@@ -94,10 +214,12 @@ def send_server_message(message_type, dest_server, message_args=None):
         "message_type": message_type.value,
         "args": message_args or {}  # Embed existing message_args here
     }
+    if group is not None:
+        message_data["args"]["group"] = group.group_id
 
-    # Serialize and send message
-    serialized_message = json.dumps(message_data)
-    networkServer.send(serialized_message.encode('utf-8'))  # Convert JSON string to bytes
+    # Serialize and send message as a single frame
+    with send_lock:
+        send_frame(networkServer, message_data)
 
     if message_type == message.LLM_RESPONSE:
         return  # Skip further processing for this message
@@ -113,116 +235,37 @@ def send_server_message(message_type, dest_server, message_args=None):
     # Add accept_val to the print message if present
     accept_val_string = ""
     if message_args and "accept_val" in message_args:
-        accept_val_txt = message_args["accept_val"]
-        accept_val_string = f"{accept_val_txt}" if accept_val_txt != -1 else "Bottom Bottom"
-    
-        # Make sure sending server isn't printed for query message
-        if accept_val_txt != -1 and accept_val_txt.startswith("query") and "." in accept_val_txt:
-            accept_val_string = accept_val_string.split(".", 1)[0]
-        else:
-            accept_val_string = accept_val_string
+        accept_val_string = accept_val_to_string(message_args["accept_val"])
 
     # Format the destination for the print message
     dest_message = "to ALL" if dest_server == -1 else f"to Server {dest_server}"
 
+    # Name the group when there is more than one
+    group_string = f" in group {group.group_id}" if group is not None and len(groups) > 1 else ""
+
     # Format and print the message
     print(
-        f"Sending {simple_message_type}{f' {ballot_string}' if ballot_string else ''}{f' {accept_val_string}' if accept_val_string else ''} {dest_message}"
+        f"Sending {simple_message_type}{f' {ballot_string}' if ballot_string else ''}{f' {accept_val_string}' if accept_val_string else ''}{group_string} {dest_message}"
     )
 
 
 def get_server_message():
     """
     Continuously receive messages from other servers or clients.
-    Reassemble fragmented messages using a buffer and parse them when complete.
-    Based on message type, call the appropriate server function.
-    Example: if message_type == "NEW_CONTEXT", call server_new_context().
+    Reassemble fragmented messages with a FrameReader and parse them when complete.
+    Each complete frame is passed to handle_server_message().
     """
-    buffer = ""  # Buffer to store partial messages
+    reader = FrameReader()  # Reusable receive buffer for the network server connection
 
     while not stop_event.is_set():
         try:
-            # Receive data from the socket in chunks
-            data = networkServer.recv(1024).decode('utf-8')
-            if not data:
+            # Receive data from the socket directly into the frame buffer
+            if reader.recv_from(networkServer) == 0:
                 print("Server Disconnected")
                 break
 
-            buffer += data  # Append received data to the buffer
-
-            while True:
-                try:
-                    # Attempt to parse a complete JSON object from the buffer
-                    message_data, end_idx = json.JSONDecoder().raw_decode(buffer)
-                    buffer = buffer[end_idx:].strip()  # Remove the processed message from the buffer
-
-                    # Extract message type and details
-                    message_type = message(message_data["message_type"])
-                    sending_server = message_data["sending_server"]
-                    args = message_data.get("args", {})
-
-                    # Special handling for LLM_RESPONSE: no printing
-                    if message_type == message.LLM_RESPONSE:
-                        server_llm_response(message_data)
-                        continue  # Skip further processing for this message
-
-                    # Extract ballot info if present
-                    ballot_string = ""
-                    if "ballot_number" in args:
-                        ballot_string = ballot_to_string(args["ballot_number"])
-
-                    # Extract accept_val if present
-                    accept_val_string = ""
-                    if "accept_val" in args:
-                        accept_val_txt = args["accept_val"]
-                        accept_val_string = f"{accept_val_txt}" if accept_val_txt != -1 else "Bottom Bottom"
-
-                        # Make sure sending server isn't printed for query message
-                        if accept_val_txt != -1 and accept_val_txt.startswith("query") and "." in accept_val_txt:
-                            accept_val_string = accept_val_string.split(".", 1)[0]
-
-                    # Extract user_message if present
-                    user_message = args.get("user_message", "")
-
-                    if user_message and user_message.startswith("query") and "." in user_message:
-                            user_message = user_message.split(".", 1)[0]
-
-                    # Format the sending server name
-                    sending_server_name = "Network Server" if sending_server == -1 else f"Server {sending_server}"
-
-                    # Format the message and print it
-                    simple_message_type = str(message_type).split(".")[-1]  # Extract simple name
-                    print(
-                        f"Received {simple_message_type}"
-                        f"{f' {ballot_string}' if ballot_string else ''}"
-                        f"{f' {accept_val_string}' if accept_val_string else ''}"
-                        f"{f' {user_message}' if user_message else ''} from {sending_server_name}"
-                    )
-
-                    # Call the appropriate function based on message type
-                    if message_type == message.SERVER_INIT:
-                        server_init_message(message_data)
-                    elif message_type == message.SERVER_KILL:
-                        server_kill_message()
-                    elif message_type == message.PREPARE:
-                        server_leader_prepare_message(message_data)
-                    elif message_type == message.PROMISE:
-                        server_leader_promise_message(message_data)
-                    elif message_type == message.LEADER_FORWARD:
-                        server_leader_forward_message(message_data)
-                    elif message_type == message.LEADER_ACK:
-                        server_leader_ack_message(message_data)
-                    elif message_type == message.ACCEPT:
-                        server_consensus_accept_message(message_data)
-                    elif message_type == message.ACCEPTED:
-                        server_consensus_accepted_message(message_data)
-                    elif message_type == message.DECIDE:
-                        server_consensus_decide_message(message_data)
-                    elif message_type == message.UPDATE_CONTEXT:
-                        server_update_context(message_data)
-                except json.JSONDecodeError:
-                    # Incomplete JSON message; wait for more data
-                    break
+            for _, payload in reader.frames():
+                handle_server_message(json.loads(payload))
 
         except Exception as e:
             print(f"Exception Thrown Getting Server Message: {e}")
@@ -230,6 +273,82 @@ def get_server_message():
     networkServer.close()
 
 
+def handle_server_message(message_data):
+    """
+    Based on message type, call the appropriate server function.
+    Example: if message_type == "PREPARE", call server_leader_prepare_message().
+    """
+    # Extract message type and details
+    message_type = message(message_data["message_type"])
+    sending_server = message_data["sending_server"]
+    args = message_data.get("args", {})
+
+    # Special handling for LLM_RESPONSE: no printing
+    if message_type == message.LLM_RESPONSE:
+        server_llm_response(message_data)
+        return  # Skip further processing for this message
+
+    # Extract ballot info if present
+    ballot_string = ""
+    if "ballot_number" in args:
+        ballot_string = ballot_to_string(args["ballot_number"])
+
+    # Extract accept_val if present
+    accept_val_string = ""
+    if "accept_val" in args:
+        accept_val_string = accept_val_to_string(args["accept_val"])
+
+    # Extract user_message if present
+    user_message = args.get("user_message", "")
+
+    if user_message and user_message.startswith("query") and "." in user_message:
+            user_message = user_message.rsplit(".", 1)[0]
+
+    # Format the sending server name
+    sending_server_name = "Network Server" if sending_server == -1 else f"Server {sending_server}"
+
+    # Consensus messages are handled by the group they belong to
+    group = groups[args["group"]] if "group" in args else None
+    group_string = f" in group {group.group_id}" if group is not None and len(groups) > 1 else ""
+
+    # Format the message and print it
+    simple_message_type = str(message_type).split(".")[-1]  # Extract simple name
+    print(
+        f"Received {simple_message_type}"
+        f"{f' {ballot_string}' if ballot_string else ''}"
+        f"{f' {accept_val_string}' if accept_val_string else ''}"
+        f"{f' {user_message}' if user_message else ''}{group_string} from {sending_server_name}"
+    )
+
+    # Call the appropriate function based on message type
+    if message_type == message.SERVER_INIT:
+        server_init_message(message_data)
+    elif message_type == message.SERVER_KILL:
+        server_kill_message()
+    elif message_type == message.PREPARE:
+        server_leader_prepare_message(group, message_data)
+    elif message_type == message.PROMISE:
+        server_leader_promise_message(group, message_data)
+    elif message_type == message.LEADER_FORWARD:
+        server_leader_forward_message(group, message_data)
+    elif message_type == message.LEADER_ACK:
+        server_leader_ack_message(message_data)
+    elif message_type == message.ACCEPT:
+        server_consensus_accept_message(group, message_data)
+    elif message_type == message.ACCEPTED:
+        server_consensus_accepted_message(group, message_data)
+    elif message_type == message.DECIDE:
+        server_consensus_decide_message(group, message_data)
+    elif message_type == message.UPDATE_CONTEXT:
+        server_update_context(group, message_data)
+    elif message_type == message.CLUSTER_UPDATE:
+        server_cluster_update_message(message_data)
+    elif message_type == message.SNAPSHOT_CHUNK:
+        server_snapshot_chunk_message(group, message_data)
+    elif message_type == message.CATCH_UP:
+        server_catch_up_message(group, message_data)
+
+
 def server_init_message(message_data):
     """
     Dakota
@@ -238,9 +357,137 @@ def server_init_message(message_data):
     global SERVER_NUM
     server_num = message_data["args"]["server_num"]
     SERVER_NUM = server_num
-    ballot_number["pid"] = server_num
+    for group in groups:
+        group.ballot_number["pid"] = server_num
 
     print(f"Assigned Server Number {SERVER_NUM}")
+    server_cluster_update_message(message_data)
+
+    # Recover the state from before a crash before handling any other message
+    for group in groups:
+        restore_from_wal(group)
+
+    if LLM_CACHE_PERSIST:
+        response_cache.load(os.path.join(DATA_DIR, f"server_{SERVER_NUM}", "llm_cache.jsonl"))
+
+def restore_from_wal(group):
+    """
+    Rebuild a group's ballot_number, accepted_slots and keyValue from this server's
+    latest snapshot of the group and the WAL segments written after it, bringing it
+    back to the op_num it reached before it stopped, then open its WAL for appending.
+    """
+    group.server_dir = os.path.join(DATA_DIR, f"server_{SERVER_NUM}", f"group_{group.group_id}")
+    os.makedirs(group.server_dir, exist_ok=True)
+
+    snapshot = read_snapshot(group.server_dir)
+    if snapshot is not None:
+        group.keyValue.replace_with(KeyValue.from_dict(snapshot["data"]))
+        group.ballot_number["op_num"] = snapshot["op_num"]
+        adopt_logged_ballot(group, snapshot["ballot"])
+        for slot, accept_num, accept_val in snapshot["accepted"]:
+            group.accepted_slots[slot] = {"accept_num": accept_num, "accept_val": accept_val}
+        group.decided_requests = OrderedDict(snapshot.get("requests", []))
+        group.last_snapshot_op_num = snapshot["op_num"]
+    elif list_segments(group.server_dir) and list_segments(group.server_dir)[0][0] > 0:
+        print("WARNING: WAL segments were compacted but no valid snapshot was found, state is incomplete")
+
+    num_records = 0
+    for record in read_wal(group.server_dir, group.last_snapshot_op_num):
+        num_records += 1
+        record_type = record["type"]
+
+        if record_type == "promise":
+            adopt_logged_ballot(group, record["ballot"])
+        elif record_type == "accept":
+            adopt_logged_ballot(group, record["accept_num"])
+            if record["slot"] >= group.ballot_number["op_num"]:
+                group.accepted_slots[record["slot"]] = {"accept_num": record["accept_num"], "accept_val": record["accept_val"]}
+        elif record_type == "decide":
+            if record["slot"] >= group.ballot_number["op_num"]:
+                group.decided_slots[record["slot"]] = record["accept_val"]
+                apply_decided_slots(group, generate=False)
+        elif record_type == "snapshot":
+            # Written by older versions, installed snapshots are now persisted as snapshot files
+            if record["op_num"] > group.ballot_number["op_num"]:
+                install_snapshot(group, record["op_num"], KeyValue.from_dict(record["context"] or {}), [], generate=False)
+
+    if snapshot is not None or num_records:
+        print(f"Restored {group.ballot_number['op_num']} operations of group {group.group_id} from snapshot at {group.last_snapshot_op_num} and {num_records} WAL records")
+
+    group.wal = WriteAheadLog(group.server_dir, group.ballot_number["op_num"])
+
+def maybe_snapshot(group):
+    """
+    Start a background snapshot once SNAPSHOT_INTERVAL_OPS operations were applied
+    or the WAL segment grew past SNAPSHOT_INTERVAL_BYTES since the last one.
+    The WAL rolls to a new segment first, so once the snapshot is durable every
+    older segment is covered by it and deleted. Only copying the contexts' columns
+    happens on the calling thread, encoding and writing happen in the background.
+    """
+    if group.wal is None or (group.snapshot_thread is not None and group.snapshot_thread.is_alive()):
+        return
+    if group.ballot_number["op_num"] - group.last_snapshot_op_num < SNAPSHOT_INTERVAL_OPS and group.wal.segment_bytes < SNAPSHOT_INTERVAL_BYTES:
+        return
+
+    take_snapshot(group)
+
+def take_snapshot(group):
+    """
+    Snapshot the group at its current op_num in the background and roll its WAL.
+    """
+    # Roll before capturing: records racing with the capture land in the new segment, and replaying them is harmless
+    snapshot_op_num = group.ballot_number["op_num"]
+    group.wal.roll(snapshot_op_num)
+    group.last_snapshot_op_num = snapshot_op_num
+
+    # Copy the state here for a consistent view: to_dict() only copies the lists of each
+    # context under its shard lock, the strings themselves are shared
+    state = {
+        "op_num": snapshot_op_num,
+        "ballot": {"seq_num": group.ballot_number["seq_num"], "pid": group.ballot_number["pid"]},
+        "accepted": [[slot, accepted["accept_num"], accepted["accept_val"]] for slot, accepted in sorted(list(group.accepted_slots.items()))],
+        "requests": list(group.decided_requests.items()),
+        "data": group.keyValue.to_dict()
+    }
+
+    group.snapshot_thread = threading.Thread(target=write_snapshot_and_compact, args=(group, state, snapshot_op_num), daemon=True)
+    group.snapshot_thread.start()
+
+def write_snapshot_and_compact(group, state, snapshot_op_num):
+    try:
+        write_snapshot(group.server_dir, json.dumps(state).encode())
+        group.wal.remove_segments_before(snapshot_op_num)
+    except OSError as e:
+        print(f"Error writing snapshot of group {group.group_id} at {snapshot_op_num}: {e}")
+
+def adopt_logged_ballot(group, ballot):
+    """
+    Keep the larger of the current ballot and a ballot read back from the WAL.
+    """
+    if ballot["seq_num"] > group.ballot_number["seq_num"] or (ballot["seq_num"] == group.ballot_number["seq_num"] and ballot["pid"] > group.ballot_number["pid"]):
+        group.ballot_number["seq_num"] = ballot["seq_num"]
+        group.ballot_number["pid"] = ballot["pid"]
+
+def log_state(group, record, durable=True):
+    """
+    Append a record to the WAL. Nothing is logged while the WAL is being replayed.
+    Args:
+        record (dict): The entry, with a "type" of promise, accept, decide or snapshot.
+        durable (bool): Wait for the record to be fsynced before returning.
+    """
+    if group.wal is not None:
+        group.wal.append(record, durable)
+
+def server_cluster_update_message(message_data):
+    """
+    Used to recompute quorum sizes when the cluster size is set or grows
+    """
+    global cluster_size, phase1_quorum, phase2_quorum
+    args = message_data["args"]
+    cluster_size = args.get("cluster_size", cluster_size)
+    phase1_quorum, phase2_quorum = quorum_sizes(cluster_size, args.get("phase2_quorum"))
+
+    print(f"Cluster Size {cluster_size}: Phase 1 Quorum {phase1_quorum}, Phase 2 Quorum {phase2_quorum}")
 
 def server_kill_message():
     """
@@ -248,9 +495,11 @@ def server_kill_message():
     Used to asign the server num when connected to the network server
     """
     stop_event.set()
+    for group in groups:
+        notify_consensus(group)
 
 
-def server_new_context(user_message):
+def server_new_context(group, user_message):
     """
     Nik
     Create a new context using the keyValue object (kv).
@@ -264,30 +513,30 @@ def server_new_context(user_message):
             print("Error Getting Context_id")
             return
         
-        if context_id in keyValue.data:
+        if context_id in group.keyValue:
             print(f"Error: Context ID '{context_id}' already exists. Please use a unique ID.")
             return
 
         # Create the new context using the keyValue object
-        keyValue.create_context(context_id)
+        group.keyValue.create_context(context_id)
         # : Server: Context created successfully on this server.")
         print(f"NEW_CONTEXT {context_id}")
 
     except Exception as e:
         print(f"Error occurred while processing NEW_CONTEXT: {e}")
 
-def server_create_query(message_data):
+def server_create_query(group, message_data, generate=True):
     """
     Nik
     Create a query in the specified context.
     Call kv.create_query() to add the query.
-    Generate a response by calling query_gemini().
+    Generate a response by calling query_gemini() unless generate is False.
     Send response back to the calling server using send_server_message().
     """
     try:
         # Extract context ID and query string from the message data
         args = message_data.get("args", {})
-        user_message, request_server = args.get("accept_val").split(".", 1)
+        user_message, request_server = args.get("accept_val").rsplit(".", 1)
         request_server = int(request_server)
 
         parts = user_message.split(" ", 2)  # Split into 'query', '<context_id>', and '<query_string>'
@@ -302,77 +551,162 @@ def server_create_query(message_data):
             return
         
         # Step 1: Add the query to the specified context
-        keyValue.create_query(context_id, query_string)
+        group.keyValue.create_query(context_id, query_string)
         # print(f"DEBUG: Server: Query added to context '{context_id}': {query_string}")
 
-        # Step 2: Retrieve the context as a string
-        context_string = keyValue.view(context_id)
+        # Step 2: Retrieve the context as a string, limited to the latest turns and a summary of the rest
+        context_string = group.keyValue.prompt(context_id, PROMPT_BUDGET_CHARS, PROMPT_SUMMARY_CHARS)
 
         if not context_string:
             print(f"Error: Context '{context_id}' not found.")
             return
         
         # Check if the context exists in KeyValue
-        if context_id not in keyValue.data:
+        if context_id not in group.keyValue:
             print(f"Error: Context ID '{context_id}' does not exist. Please create the context first.")
             return
         
         # Print updated context with query
         print(f"NEW_QUERY on {context_id} with {context_string}")
 
-        # Step 3: Generate a response by querying Gemini
-        prompt_answer = ""
-        response = query_gemini(context_string + "\n" + prompt_answer)
-        if request_server == SERVER_NUM:
-            save_response_to_dict(context_id, response)
+        # Replayed during catch-up, the requesting server already has its candidates
+        if not generate:
+            return
 
+        # Step 3: Generate a response on the LLM pool so consensus keeps running meanwhile
+        llm_pool.submit(generate_query_response, context_id, query_string, context_string, request_server)
 
-        # Step 4: Send the response back to the calling server
-        response_message = {
-            "context_id": context_id,
-            "query_string": query_string,
-            "response": response
-        }
-        
-        if request_server == SERVER_NUM:
-            # print(response)
-            pass
+    except Exception as e:
+        print(f"Error occurred while processing CREATE_QUERY: {e}")
+
+def generate_query_response(context_id, query_string, context_string, request_server):
+    """
+    Runs on llm_pool: query Gemini with the context as it was when the query was
+    decided and deliver the response to the server that asked for it, chunk by
+    chunk as it is generated when LLM_STREAM is set.
+    """
+    candidate_id = f"{SERVER_NUM}.{next(candidate_numbers)}"
+    chunk_index = 0
+    truncated = False
+    try:
+        prompt_answer = ""
+        if LLM_STREAM:
+            chunks = stream_gemini(context_string + "\n" + prompt_answer)
         else:
-            send_server_message(message.LLM_RESPONSE, request_server, response_message)
+            response = query_gemini(context_string + "\n" + prompt_answer)
+            if response is None:
+                return  # Nothing to offer as a candidate, the error was already reported
+            chunks = [response]
 
+        for text in chunks:
+            deliver_response_chunk(context_id, query_string, request_server, candidate_id, chunk_index, text, False)
+            chunk_index += 1
+
+    except LLMError as e:
+        print(f"Error querying Gemini: {e}")
+        if chunk_index == 0:
+            return  # Nothing to offer as a candidate
+        truncated = True
     except Exception as e:
-        print(f"Error occurred while processing CREATE_QUERY: {e}")
+        print(f"Error occurred while generating response for {context_id}: {e}")
+        if chunk_index == 0:
+            return
+        truncated = True
+
+    # Mark the candidate complete, or cut off by a failure so it is not chosen as an answer
+    deliver_response_chunk(context_id, query_string, request_server, candidate_id, chunk_index, "", True, truncated)
+
+def deliver_response_chunk(context_id, query_string, request_server, candidate_id, chunk_index, text, final, truncated=False):
+    """
+    Hand one chunk of a candidate to save_response_to_dict() locally, or send it
+    to the requesting server as LLM_RESPONSE.
+    """
+    if request_server == SERVER_NUM:
+        save_response_to_dict(context_id, query_string, candidate_id, chunk_index, text, final, truncated)
+        return
+
+    # Step 4: Send the response back to the calling server
+    response_message = {
+        "context_id": context_id,
+        "query_string": query_string,
+        "candidate_id": candidate_id,
+        "chunk_index": chunk_index,
+        "response": text,
+        "final": final,
+        "truncated": truncated
+    }
+    send_server_message(message.LLM_RESPONSE, request_server, response_message)
 
 def server_llm_response(message_data):
     """
-    Add the received LLM response to the llm_responses collection.
+    Add the received LLM response chunk to the llm_responses collection.
     Print the response for server-side logging.
     """
     
     args = message_data.get("args", {})
-    response = args.get("response")
-    context_id = args.get("context_id")
     
     #Add responses to datastructure
-    save_response_to_dict(context_id, response)
+    save_response_to_dict(args.get("context_id"), args.get("query_string"), args.get("candidate_id"), args.get("chunk_index"), args.get("response"), args.get("final"), args.get("truncated", False))
     
-def save_response_to_dict(context_id, response):
+def save_response_to_dict(context_id, query_string, candidate_id, chunk_index, text, final, truncated=False):
     """
-    Helper Function To Add Response to response_dict
+    Helper Function To Add Response chunks to response_dict
+    A candidate gets its number when its first chunk arrives and every later chunk
+    is appended in chunk_index order, so it can be chosen before it is complete.
+    Chunks answering an earlier query than the context's current one, or of a
+    candidate that was dropped or never started, are discarded. A candidate whose
+    final chunk is truncated stays listed but can no longer be chosen.
     """
-    #Create List if needed
-    if (context_id) not in response_dict:
-        response_dict[(context_id)] = []
-    
-    #Get The Candidate Num
-    candidate_num = len(response_dict[context_id])
+    with response_lock:
+        if current_queries.get(context_id) != query_string:
+            return
+
+        key = (context_id, candidate_id)
+        if key not in streaming_candidates:
+            if chunk_index != 0:
+                return
+            streaming_candidates[key] = {"index": None, "next_chunk": 0, "pending": {}}
+        candidate = streaming_candidates[key]
+        candidate["pending"][chunk_index] = (text, final, truncated)
+
+        # Apply every chunk that is next in order
+        started = False
+        completed = False
+        while candidate["next_chunk"] in candidate["pending"]:
+            text, final, truncated = candidate["pending"].pop(candidate["next_chunk"])
+            candidate["next_chunk"] += 1
+
+            if candidate["index"] is None:
+                #Create List if needed
+                if (context_id) not in response_dict:
+                    response_dict[(context_id)] = []
+
+                #Get The Candidate Num
+                candidate["index"] = len(response_dict[context_id])
+                response_dict[context_id].append("")
+                started = True
+
+            response_dict[context_id][candidate["index"]] += text
+            if final:
+                completed = True
+                if truncated:
+                    truncated_candidates.add((context_id, candidate["index"]))
+                del streaming_candidates[key]
+                break
 
-    #Add to response dict and print
-    response_dict[context_id].append(response)
-    print(f"Context '{context_id}' - Candidate {candidate_num}: {response}")
+        candidate_num = candidate["index"]
+        response = response_dict[context_id][candidate_num] if candidate_num is not None else ""
 
+    # Print the first chunk right away and the whole response once complete
+    if started and not completed:
+        print(f"Context '{context_id}' - Candidate {candidate_num} (streaming): {response}")
+    if completed and truncated:
+        print(f"Context '{context_id}' - Candidate {candidate_num} (truncated, cannot be chosen): {response}")
+    elif completed:
+        print(f"Context '{context_id}' - Candidate {candidate_num}: {response}")
 
-def server_choose_response(message_data):
+
+def server_choose_response(group, message_data):
     """
     Save the selected answer to the keyValue storage.
     Call kv.save_answer() to persist the answer.
@@ -393,7 +727,7 @@ def server_choose_response(message_data):
         print("Error: Context ID and query cannot be empty.")
         return
 
-    keyValue.save_answer(context_id, response)
+    group.keyValue.save_answer(context_id, response)
 
     print(f"CHOSEN ANSWER on {context_id} with {response}")
     
@@ -414,6 +748,8 @@ def get_user_input():
             continue
         if user_input.lower() == 'exit':
             stop_event.set()
+            for group in groups:
+                notify_consensus(group)
             if networkServer != None:
                 networkServer.close()
             break
@@ -426,6 +762,8 @@ def get_user_input():
             user_select_answer(user_input)
         elif user_input.startswith("viewall"):
             user_view_all_context()
+        elif user_input == "cache":
+            user_view_cache_stats()
         elif user_input.startswith("view"):
             user_view_context(user_input)
         else:
@@ -478,8 +816,18 @@ def user_create_query(user_message):
     
     # Clear responses only for the given context_id
     global response_dict
-    if context_id in response_dict:
-        response_dict[context_id].clear()
+    with response_lock:
+        if context_id in response_dict:
+            response_dict[context_id].clear()
+
+        # Chunks of candidates for the previous query are dropped from now on
+        for key in [key for key in streaming_candidates if key[0] == context_id]:
+            del streaming_candidates[key]
+        for key in [key for key in truncated_candidates if key[0] == context_id]:
+            truncated_candidates.discard(key)
+
+        # Only collect candidates for this query, without the requesting server suffix
+        current_queries[context_id] = user_message.rsplit(".", 1)[0].split(" ", 2)[2].strip()
     
 
     # Get consensus from all servers
@@ -515,6 +863,11 @@ def user_select_answer(user_message):
         if response_number < 0 or response_number >= len(response_dict[context_id]):
             print(f"Invalide Response Number {response_number}")
             return
+
+        # A response cut off by an LLM error is not a full answer
+        if (context_id, response_number) in truncated_candidates:
+            print(f"Response Number {response_number} was cut off by an LLM error and cannot be chosen")
+            return
         
     except ValueError:
         print("Invalid format. context_id and response_number must be integers.")
@@ -532,7 +885,7 @@ def user_view_context(user_message):
     """
     # Extract the context ID from the user message
     context_id = user_message.replace("view", "").strip()
-    context_data = keyValue.view(context_id)  # Call the KeyValue store's view method
+    context_data = context_group(context_id).keyValue.view(context_id)  # Call the KeyValue store's view method
 
     if not context_data:
         print(f"Context '{context_id}' not found or context is empty.")
@@ -541,26 +894,32 @@ def user_view_context(user_message):
     # Print the formatted context data with quotation marks and context ID
     print(f"{context_id} = \"\"\"\n{context_data}\n\"\"\"")
 
+def user_view_cache_stats():
+    """
+    Print the LLM response cache hit/miss counters and size.
+    """
+    stats = response_cache.stats()
+    lookups = stats["hits"] + stats["misses"]
+    hit_rate = stats["hits"] / lookups if lookups else 0.0
+    print(f"LLM Cache: {stats['hits']} hits, {stats['misses']} misses ({hit_rate:.1%}), {stats['entries']} entries, {stats['bytes']} bytes")
+
 def user_view_all_context():
     """
     Retrieve and display all contexts.
-    Use keyValue.view_all() to list all contexts.
+    Use keyValue.view_all() of every group to list all contexts.
     """
-    all_contexts = keyValue.view_all()  # Call the KeyValue store's view_all method
-
-    if not all_contexts:
-        print("No contexts available.")
-        return
-
-    # Format all context data for display
-    formatted_output = []
-    for context_id, context_data in all_contexts.items():
-        formatted_output.append(f"{context_id} = \"\"\"")
-        for item in context_data:
-            formatted_output.append(f"Query: {item['query']}\nAnswer: {item['answer']}")
+    # Format and print one context at a time from the KeyValue stores' view_all method
+    num_contexts = 0
+    for context_id, turns in itertools.chain.from_iterable(group.keyValue.view_all() for group in groups):
+        formatted_output = [f"{context_id} = \"\"\""]
+        for query, answer in turns:
+            formatted_output.append(f"Query: {query}\nAnswer: {answer}")
         formatted_output.append("\"\"\"")
+        print("\n".join(formatted_output))
+        num_contexts += 1
 
-    print("\n".join(formatted_output))
+    if not num_contexts:
+        print("No contexts available.")
 
 # ------  CONSENSUS  ------
     
@@ -576,46 +935,86 @@ def ballot_to_string(ballot_num):
     """
     return f"<{ballot_num['seq_num']}, {ballot_num['pid']}, {ballot_num['op_num']}>" 
 
+def operations_in(accept_val):
+    """
+    List the user operations carried by an accept_val.
+    An accept_val is -1 (no-op), a single operation, or a batch (list) of operations.
+    An operation is {"request_id", "user_message"}, plain strings logged by older
+    versions are returned as operations without a request_id.
+    """
+    if accept_val == -1:
+        return []
+    if not isinstance(accept_val, list):
+        accept_val = [accept_val]
+    return [operation if isinstance(operation, dict) else {"request_id": None, "user_message": operation} for operation in accept_val]
+
+def accept_val_to_string(accept_val):
+    """
+    Format an accept_val for printing, without the requesting server suffix on queries.
+    """
+    if accept_val == -1:
+        return "Bottom Bottom"
+
+    operation_strings = []
+    for operation in operations_in(accept_val):
+        user_message = operation["user_message"]
+        # Make sure sending server isn't printed for query message
+        if user_message.startswith("query") and "." in user_message:
+            user_message = user_message.rsplit(".", 1)[0]
+        operation_strings.append(user_message)
+    return " | ".join(operation_strings)
+
     
 # --- Election Phase ---
-def leader_init():
+def leader_init(group):
     
     # print("DEBUG: Leader init")
-    if leader == -1:
-        start_leader_election()
+    # Concurrent submissions share one election instead of each starting their own
+    with group.election_lock:
+        if group.leader == -1:
+            start_leader_election(group)
 
-def start_leader_election():
+def start_leader_election(group):
 
     # print("DEBUG: Starting Election")
-    global num_leader_promises, ballot_number, leader, accept_num, accept_val
     
-    num_leader_promises = 0
+    group.num_leader_promises = 0
+
+    # Start recovery from the values this server accepted itself
+    group.recovered_slots.clear()
+    for slot, accepted in list(group.accepted_slots.items()):
+        merge_recovered_slot(group, slot, accepted["accept_num"], accepted["accept_val"])
     
     # Update currently known ballot with your PID to create new ballot
-    ballot_number["seq_num"] += 1
-    ballot_number["pid"] = SERVER_NUM
+    group.ballot_number["seq_num"] += 1
+    group.ballot_number["pid"] = SERVER_NUM
+    log_state(group, {"type": "promise", "ballot": {"seq_num": group.ballot_number["seq_num"], "pid": group.ballot_number["pid"]}})
     message_args = {
-        "ballot_number": ballot_number,
+        "ballot_number": group.ballot_number,
     }
-    send_server_message(message.PREPARE, -1, message_args)
+    send_server_message(message.PREPARE, -1, message_args, group=group)
 
-    # Wait for all servers to respond with a timeout
-    start_time = time.time()  # Record the start time
-    while num_leader_promises < MAX_SERVER_NUM - 2:
-        time.sleep(0.1)
-        if time.time() - start_time > (TIMEOUT_TIME):  # Check if TIMEOUT seconds have elapsed
-            print("TIMEOUT: Leader promises not received.")
+    # Wait for a phase-1 quorum (this server counts itself) to respond with a timeout
+    with group.consensus_condition:
+        got_quorum = group.consensus_condition.wait_for(
+            lambda: group.num_leader_promises >= phase1_quorum - 1 or stop_event.is_set(),
+            timeout=TIMEOUT_TIME
+        )
 
-            # Added by Nik
-            if ballot_number["pid"] != SERVER_NUM:
-                return
-            
-            # Restart leader election
-            leader_init()
-            #get_consensus()
-            return
-        if stop_event.is_set():
+    if stop_event.is_set():
+        return
+
+    if not got_quorum:
+        print("TIMEOUT: Leader promises not received.")
+
+        # Added by Nik
+        if group.ballot_number["pid"] != SERVER_NUM:
             return
+        
+        # Restart leader election
+        leader_init(group)
+        #get_consensus()
+        return
 
     
     # # Added by Nik to handle getting another prepare 
@@ -623,133 +1022,281 @@ def start_leader_election():
     #     leader_init()
     #     return
 
-    if ballot_number["pid"] != SERVER_NUM:
-        leader = ballot_number["pid"]
+    if group.ballot_number["pid"] != SERVER_NUM:
+        group.leader = group.ballot_number["pid"]
         return
     
-    leader = SERVER_NUM
-    threading.Thread(target=run_leader).start()
+    group.leader = SERVER_NUM
+    threading.Thread(target=run_leader, args=(group,)).start()
 
-def server_leader_prepare_message(message_data):
+def server_leader_prepare_message(group, message_data):
     """
     Handle recieving a prepare message from server who wants to be leader
     """
 
     # Extract context ID and query string from the message data
-    global ballot_number
-    global accept_val
-    global accept_num
-    global leader
     args = message_data.get("args", {})
     ballot = args.get("ballot_number")
     sending_server = message_data.get("sending_server")
 
     # Handle case that non-leader failed and is trying to get context
-    if leader == SERVER_NUM:
-        message_args = {
-            # TODO: Is KeyValue the best way to send all of the context?
-            "context": keyValue.to_dict(),  # Serialize the KeyValue object
-            "op_num": ballot_number["op_num"],
-            "leader": leader
-        }
-        send_server_message(message.UPDATE_CONTEXT, sending_server, message_args)
+    if group.leader == SERVER_NUM:
+        send_update_context(group, sending_server, ballot["op_num"])
 
 
 
     # Return Promise if message seq_num greater than local seq_num, and set local seq_num to new value
-    elif ballot["seq_num"] > ballot_number["seq_num"] or (ballot["seq_num"] == ballot_number["seq_num"] and ballot["pid"] == ballot_number["pid"]) or (ballot["seq_num"] == ballot_number["seq_num"] and ballot["pid"] > ballot_number["pid"]):
+    elif ballot["seq_num"] > group.ballot_number["seq_num"] or (ballot["seq_num"] == group.ballot_number["seq_num"] and ballot["pid"] == group.ballot_number["pid"]) or (ballot["seq_num"] == group.ballot_number["seq_num"] and ballot["pid"] > group.ballot_number["pid"]):
         # If proposer's op_num is lower, send update their context will up-to-date operations
-        if ballot["op_num"] < ballot_number["op_num"]:
-            message_args = {
-                # TODO: Is KeyValue the best way to send all of the context?
-                "context": keyValue.to_dict(),  # Serialize the KeyValue object
-                "op_num": ballot_number["op_num"],
-                "leader": leader
-            }
-            send_server_message(message.UPDATE_CONTEXT, sending_server, message_args)
+        if ballot["op_num"] < group.ballot_number["op_num"]:
+            send_update_context(group, sending_server, ballot["op_num"])
 
         else:
             # Set maximum known ballot to recieved ballot
 
             # Set a help flag if acceptor has a lower number of operations completed than leader
-            help_needed = ballot["op_num"] > ballot_number["op_num"]
+            help_needed = ballot["op_num"] > group.ballot_number["op_num"]
         
-            ballot_number = ballot
+            # op_num keeps counting the operations applied here, only the ballot itself is adopted
+            group.ballot_number["seq_num"] = ballot["seq_num"]
+            group.ballot_number["pid"] = ballot["pid"]
+            notify_consensus(group)
+
+            # The promise must survive a crash before it is sent
+            log_state(group, {"type": "promise", "ballot": {"seq_num": ballot["seq_num"], "pid": ballot["pid"]}})
             
+            # Report every accepted but undecided slot so the new leader can re-propose it
             message_args = {
-                "ballot_number": ballot_number,
-                "accept_val": accept_val,
-                "accept_num": accept_num,
-                "help": help_needed
+                "ballot_number": ballot,
+                "accepted": [[slot, accepted["accept_num"], accepted["accept_val"]] for slot, accepted in sorted(list(group.accepted_slots.items()))],
+                "help": help_needed,
+                "op_num": group.ballot_number["op_num"]
             }
             
             # Send a promise to proposer with this server's ballot
-            send_server_message(message.PROMISE, sending_server, message_args)
+            send_server_message(message.PROMISE, sending_server, message_args, group=group)
 
 
 
       
-def server_update_context(message_data):
+def server_update_context(group, message_data):
     """
     Function called when a server trying to be leader recieves
     UPDATE_CONTEXT because their op_num is lagging behind.
-    Replaces its key-value with the sending server's and updates
-    op_num.
+    Applies the decided values it is missing and updates op_num.
     """
-    global keyValue
-    global ballot_number
-    global leader
     args = message_data.get("args", {})
 
     if(args["leader"] != SERVER_NUM):
-        leader = args["leader"]
+        group.leader = args["leader"]
+
+    # Incremental catch-up: treat the missing values as decided and apply them in order.
+    # Decisions received normally and buffered behind the gap still query the LLM
+    with group.apply_lock:
+        log_start = args.get("log_start")
+        replayed_slots = set()
+        for offset, value in enumerate(args.get("log")):
+            slot = log_start + offset
+            if slot >= group.ballot_number["op_num"] and slot not in group.decided_slots:
+                group.decided_slots[slot] = value
+                replayed_slots.add(slot)
+        apply_decided_slots(group, replayed_slots=replayed_slots)
+
+def install_snapshot(group, op_num, staged, requests, generate=True):
+    """
+    Replace a group's keyValue and op_num with a snapshot of another server's copy of the group.
+    Args:
+        staged (KeyValue): The received contexts, swapped in as they are.
+        requests (list): The [request_id, slot] pairs the snapshot's server recorded as decided.
+    """
+    with group.apply_lock:
+        group.ballot_number["op_num"] = op_num
 
-    # Update context and op_num
-    ballot_number["op_num"] = args.get("op_num")
-    received_data = args.get("context")
+        # Swap the staged contexts in at once, LLM threads keep a consistent view
+        group.keyValue.replace_with(staged)
+        group.decided_requests = OrderedDict(requests)
 
-    if received_data:
-        keyValue = KeyValue.from_dict(received_data)  # Rebuild KeyValue object
+        # The log no longer ends right below op_num, so it cannot be used for catch-up
+        group.decided_log.clear()
 
+        # Forget slots covered by the received context
+        for slot in [slot for slot in list(group.accepted_slots) if slot < group.ballot_number["op_num"]]:
+            del group.accepted_slots[slot]
+        for slot in [slot for slot in list(group.decided_slots) if slot < group.ballot_number["op_num"]]:
+            del group.decided_slots[slot]
 
-    # Restart leader election 
-    #TODO: maybe call leader_init instead??
-    # start_leader_election()
+        # Persist the installed state as a snapshot of its own instead of logging the whole store,
+        # after any snapshot being written so this one is not skipped
+        if group.wal is not None:
+            if group.snapshot_thread is not None:
+                group.snapshot_thread.join()
+            take_snapshot(group)
 
+        # Apply any buffered decisions after it
+        apply_decided_slots(group, generate)
 
-def server_leader_promise_message(message_data):
+def send_update_context(group, dest_server, peer_op_num):
+    """
+    Catch up a server that has applied peer_op_num operations.
+    Sends only the decided values it is missing in an UPDATE_CONTEXT when decided_log
+    still holds all of them, and streams a KeyValue snapshot otherwise. A server that
+    is not behind gets an empty log, which still tells it who the leader is.
+    """
+    with group.apply_lock:
+        op_num = group.ballot_number["op_num"]
+        first_logged = op_num - len(group.decided_log)
+        in_log = peer_op_num is not None and first_logged <= peer_op_num
+        if in_log:
+            log = [group.decided_log[slot] for slot in range(peer_op_num, op_num)]
+
+    if not in_log:
+        send_snapshot(group, dest_server)
+        return
+
+    message_args = {
+        "op_num": op_num,
+        "leader": group.leader,
+        "log_start": peer_op_num,
+        "log": log
+    }
+    send_server_message(message.UPDATE_CONTEXT, dest_server, message_args, group=group)
+
+def send_snapshot(group, dest_server):
+    """
+    Stream a group's keyValue to a server as SNAPSHOT_CHUNK messages of whole contexts, each
+    compressed and checksummed, so neither side holds the whole store as one message.
+    The chunks are sent from a thread of their own, SNAPSHOT_CHUNK_INTERVAL apart, so
+    this server keeps handling messages and other traffic is relayed in between chunks.
+    """
+    sender = group.snapshot_senders.get(dest_server)
+    if sender is not None and sender.is_alive():
+        return  # The transfer in progress already brings it up to date
+
+    # Copy each context's columns (not the strings) at a consistent op_num
+    with group.apply_lock:
+        op_num = group.ballot_number["op_num"]
+        contexts = group.keyValue.to_dict()
+        requests = list(group.decided_requests.items())
+
+    sender = threading.Thread(target=stream_snapshot, args=(group, dest_server, op_num, contexts, requests), daemon=True)
+    group.snapshot_senders[dest_server] = sender
+    sender.start()
+
+def stream_snapshot(group, dest_server, op_num, contexts, requests):
+    transfer_id = f"{SERVER_NUM}.{op_num}.{time.time()}"
+    contexts = iter(contexts.items())
+    next_context = next(contexts, None)
+
+    index = 0
+    while True:
+        # Group whole contexts until the chunk reaches SNAPSHOT_CHUNK_BYTES
+        chunk = {}
+        chunk_bytes = 0
+        while next_context is not None and (not chunk or chunk_bytes < SNAPSHOT_CHUNK_BYTES):
+            context_id, context_data = next_context
+            chunk[context_id] = context_data
+            chunk_bytes += len(context_id) + len(json.dumps(context_data))
+            next_context = next(contexts, None)
+
+        compressed = zlib.compress(json.dumps(chunk).encode())
+        final = next_context is None
+        message_args = {
+            "transfer_id": transfer_id,
+            "index": index,
+            "data": base64.b64encode(compressed).decode(),
+            "crc": zlib.crc32(compressed),
+            "final": final,
+            "op_num": op_num,
+            "leader": group.leader
+        }
+        if final:
+            message_args["requests"] = requests
+        send_server_message(message.SNAPSHOT_CHUNK, dest_server, message_args, group=group)
+
+        if final or stop_event.wait(SNAPSHOT_CHUNK_INTERVAL):
+            return
+        index += 1
+
+def server_snapshot_chunk_message(group, message_data):
+    """
+    Apply a SNAPSHOT_CHUNK into a staging KeyValue, and swap the staged store in
+    once the final chunk arrives.
+    A missing, out of order or corrupt chunk abandons the transfer, the sender
+    starts a new one the next time it notices this server is behind.
+    Several peers may stream to this server at once, chunks of any other transfer
+    are ignored until the one being staged completes or stalls for TIMEOUT_TIME.
+    """
+    args = message_data.get("args", {})
+
+    transfer = group.snapshot_transfer
+    if transfer is not None and transfer["transfer_id"] != args["transfer_id"] and time.time() - transfer["last_chunk_time"] < TIMEOUT_TIME:
+        return
+
+    if args["index"] == 0:
+        group.snapshot_transfer = {"transfer_id": args["transfer_id"], "next_index": 0, "last_chunk_time": time.time(), "staging": KeyValue()}
+    elif group.snapshot_transfer is None or group.snapshot_transfer["transfer_id"] != args["transfer_id"] or group.snapshot_transfer["next_index"] != args["index"]:
+        print(f"Dropping snapshot chunk {args['index']} of {args['transfer_id']}: transfer not in progress")
+        group.snapshot_transfer = None
+        return
+
+    compressed = base64.b64decode(args["data"])
+    if zlib.crc32(compressed) != args["crc"]:
+        print(f"Dropping snapshot {args['transfer_id']}: checksum mismatch in chunk {args['index']}")
+        group.snapshot_transfer = None
+        return
+
+    staging = group.snapshot_transfer["staging"]
+    staging.load_contexts(json.loads(zlib.decompress(compressed)))
+    group.snapshot_transfer["next_index"] += 1
+    group.snapshot_transfer["last_chunk_time"] = time.time()
+
+    if not args["final"]:
+        return
+
+    group.snapshot_transfer = None
+    if(args["leader"] != SERVER_NUM):
+        group.leader = args["leader"]
+
+    with group.apply_lock:
+        if args["op_num"] <= group.ballot_number["op_num"]:
+            return  # Caught up some other way while the snapshot was streaming
+
+        install_snapshot(group, args["op_num"], staging, args.get("requests", []))
+
+
+def server_leader_promise_message(group, message_data):
     """
     Handle recieving a promise message from a server after sending a prepare.
-    Compare their accept_num to yours. If their's is not -1 and is bigger than yours,
-    set your accept_val to their accept_val.
+    For every slot they accepted, keep their accept_val if their accept_num
+    is bigger than the one recovered so far.
     """
-    global accept_val
-    global accept_num
     args = message_data.get("args", {})
-    received_accept_num = args.get("accept_num")
-    received_accept_val = args.get("accept_val")
 
     # Handle case that an acceptor is behind in number of operation by sending them an update context message
     if args.get("help"): 
-        message_args = {
-                "context": keyValue.to_dict(),  # Serialize the KeyValue object
-                "op_num": ballot_number["op_num"],
-                "leader": leader
-        }
-        send_server_message(message.UPDATE_CONTEXT, message_data.get("sending_server"), message_args)
+        send_update_context(group, message_data.get("sending_server"), args.get("op_num"))
         
-    time.sleep(.2)
+    with group.consensus_condition:
+        for slot, received_accept_num, received_accept_val in args.get("accepted", []):
+            merge_recovered_slot(group, slot, received_accept_num, received_accept_val)
 
-    if received_accept_num != -1:
-        if accept_num == -1:
-            accept_num = received_accept_num
-            accept_val = received_accept_val
-        elif accept_num != -1 and (received_accept_num["seq_num"] > accept_num["seq_num"] or (received_accept_num["seq_num"] == accept_num["seq_num"] and received_accept_num["pid"] > accept_num["pid"])):
-            accept_num = received_accept_num
-            accept_val = received_accept_val
+        group.num_leader_promises += 1
+        group.consensus_condition.notify_all()
 
-    global num_leader_promises
-    num_leader_promises += 1
+def merge_recovered_slot(group, slot, received_accept_num, received_accept_val):
+    """
+    Keep the value with the highest accept_num for a slot not yet applied here.
+    """
+    if slot < group.ballot_number["op_num"]:
+        return
+
+    if slot not in group.recovered_slots:
+        group.recovered_slots[slot] = (received_accept_num, received_accept_val)
+        return
+
+    accept_num = group.recovered_slots[slot][0]
+    if received_accept_num["seq_num"] > accept_num["seq_num"] or (received_accept_num["seq_num"] == accept_num["seq_num"] and received_accept_num["pid"] > accept_num["pid"]):
+        group.recovered_slots[slot] = (received_accept_num, received_accept_val)
 
 
     # --- Decision Phase ---
@@ -758,265 +1305,575 @@ def server_leader_promise_message(message_data):
 #     #Insert message and ballot to queue
 #     pending_operations.put((user_message, ballot))
 
-def insert_operation_to_queue(user_message):
+def insert_operation_to_queue(group, operation):
+
+    # Resubmitted operations are queued once and not again once decided
+    if operation["request_id"] in group.decided_requests:
+        return
 
     #Insert message to queue
-    if user_message not in list(pending_operations.queue):
-        pending_operations.put(user_message)
+    if all(queued["request_id"] != operation["request_id"] for queued in list(group.pending_operations.queue)):
+        group.pending_operations.put(operation)
+        notify_consensus(group)
+
+def notify_consensus(group):
+    """
+    Wake every thread waiting on consensus_condition so it re-checks its condition.
+    """
+    with group.consensus_condition:
+        group.consensus_condition.notify_all()
+
+class ConsensusRequest:
+    """
+    Handle for an operation submitted with get_consensus().
+    acked completes with the leader's server number once the leader queued the operation,
+    decided completes with the operation once it was applied on this server.
+    The request_id goes with the operation through consensus, so however often it is
+    resubmitted or re-proposed it is applied once.
+    """
+
+    def __init__(self, user_message, request_id):
+        self.user_message = user_message
+        self.request_id = request_id
+        self.operation = {"request_id": request_id, "user_message": user_message}
+        self.group = operation_group(user_message)  # Group of the context the operation is on
+        self.acked = Future()
+        self.decided = Future()
+        self.attempts = 0
+        self.acked_attempt = 0  # Attempt the last LEADER_ACK arrived for
+
+def get_consensus(user_message, request_id=None):
+    """
+    Submit an operation for consensus without blocking the caller.
+    Leader discovery, forwarding and retrying on a missing LEADER_ACK or decision
+    happen on a background thread, so many operations can be outstanding at once.
+    Args:
+        request_id (str): ID of an operation submitted before, a new one is given otherwise.
+    Returns:
+        ConsensusRequest: Handle that completes on LEADER_ACK and again on decide.
+    """
+    if request_id is None:
+        request_id = f"{SERVER_NUM}.{START_TIME}.{next(request_numbers)}"
+
+    with requests_lock:
+        request = outstanding_requests.get(request_id)
+        if request is None:
+            request = ConsensusRequest(user_message, request_id)
+            outstanding_requests[request_id] = request
 
-def get_consensus(user_message):
+    threading.Thread(target=submit_request, args=(request,), daemon=True).start()
+    return request
+
+def submit_request(request):
     """
-    Implement a method to achieve consensus among servers.
-    Communicate with all servers to confirm action or context creation.
-    Return consensus result to calling function.
+    Hand a request to the leader of its group (electing one first if none is known).
+    On the leader it is queued and acknowledged directly, otherwise it is forwarded
+    and a timer retries if no LEADER_ACK arrives within TIMEOUT_TIME. Either way it is
+    submitted again if it is not decided within DECIDE_TIMEOUT, in case the leader
+    failed after acknowledging it.
     """
-    global leader
-    leader_init()
+    if stop_event.is_set() or request.decided.done():
+        return
+
+    group = request.group
+
+    leader_init(group)
+    request.attempts += 1
 
     #If leader add operation to operation queue
-    if leader == SERVER_NUM:
-        insert_operation_to_queue(user_message)
+    if group.leader == SERVER_NUM:
+        insert_operation_to_queue(group, request.operation)
+        complete_request_ack(request.request_id, group.leader)
     #If not send message to leader to do so
     else:
-        global leader_ack
-        leader_ack = 0
         message_args = {
-            "user_message": user_message,
+            "user_message": request.user_message,
+            "request_id": request.request_id,
         }
-        send_server_message(message.LEADER_FORWARD, leader, message_args)
+        send_server_message(message.LEADER_FORWARD, group.leader, message_args, group=group)
 
         #Check To Make Sure Leader Forward Has been Received
-        time.sleep(TIMEOUT_TIME)
-        if leader_ack == 0:
-            print(f"TIMEOUT: Leader Acknowledge Not Received from {leader} for message: {user_message}")
-            
-            # Assume leader failed, set leader to none
-            leader = -1
+        timer = threading.Timer(TIMEOUT_TIME, check_request_ack, args=(request, group.leader, request.attempts))
+        timer.daemon = True
+        timer.start()
 
-            # Rerun get consensus with no known leader 
-            get_consensus(user_message)
+    # Check the acknowledged operation is decided, the request_id makes resubmitting it safe
+    timer = threading.Timer(DECIDE_TIMEOUT, check_request_decided, args=(request, request.attempts))
+    timer.daemon = True
+    timer.start()
+
+def check_request_ack(request, forwarded_to, attempt):
+    """
+    Runs TIMEOUT_TIME after a LEADER_FORWARD, resubmits the request if it was not acknowledged.
+    """
+    if request.acked_attempt == attempt or request.decided.done() or attempt != request.attempts or stop_event.is_set():
+        return
+
+    print(f"TIMEOUT: Leader Acknowledge Not Received from {forwarded_to} for message: {request.user_message}")
+
+    # Assume leader failed, set leader to none
+    if request.group.leader == forwarded_to:
+        request.group.leader = -1
+
+    # Rerun with no known leader
+    submit_request(request)
+
+def check_request_decided(request, attempt):
+    """
+    Runs DECIDE_TIMEOUT after submitting a request, resubmits it if it was not decided.
+    """
+    if request.decided.done() or attempt != request.attempts or stop_event.is_set():
+        return
+
+    print(f"TIMEOUT: Decision Not Received for message: {request.user_message}")
+    submit_request(request)
+
+def complete_request_ack(request_id, leader_num):
+    with requests_lock:
+        request = outstanding_requests.get(request_id)
+        if request is None:
+            return
+        request.acked_attempt = request.attempts
+        if not request.acked.done():
+            request.acked.set_result(leader_num)
+
+def complete_request_decided(group, request_id):
+    with requests_lock:
+        request = outstanding_requests.pop(request_id, None)
+    if request is None:
+        return
+    if not request.acked.done():
+        request.acked.set_result(group.leader)
+    request.decided.set_result(request.user_message)
         
 
-def run_leader():
+def run_leader(group):
+    """
+    Multi-Paxos leader loop of one group, run while this server leads it.
+    Keeps up to PIPELINE_WINDOW slots in flight at once, each with its own ballot
+    (op_num = slot), and decides them strictly in slot order as their quorums arrive.
+    """
 
-    #global num_consensus_accepted
-    global num_consensus
-    global accept_val
-    global accept_num
-    global leader
+    group.inflight_slots.clear()
+    next_slot = group.ballot_number["op_num"]
+
+    # Values recovered from promises are re-proposed first at their own slots, gaps become no-ops
+    last_recovered = max(group.recovered_slots, default=next_slot - 1)
+    recovered_values = [group.recovered_slots.get(slot, (None, -1))[1] for slot in range(next_slot, last_recovered + 1)]
+    group.recovered_slots.clear()
+    for value in recovered_values:
+        for operation in operations_in(value):
+            remove_pending_operation(group, operation)
 
     while not stop_event.is_set():
-        if not pending_operations.empty():
 
-            ball_num = copy.deepcopy(ballot_number)
+        # added by Nik
+        if group.ballot_number["pid"] != SERVER_NUM:
+            group.leader = group.ballot_number["pid"]
+            return
+
+        # Fill the window with new slots
+        progress = False
+        while len(group.inflight_slots) < PIPELINE_WINDOW:
+            if recovered_values:
+                value = recovered_values.pop(0)
+            elif not group.pending_operations.empty():
+                value = next_batch(group)
+                if value == -1:
+                    continue  # Every queued operation was already decided or in flight
+            else:
+                break
+            propose_slot(group, next_slot, value)
+            next_slot += 1
+            progress = True
+
+        # Decide every slot at the front of the window that reached a phase-2 quorum
+        while oldest_slot_has_quorum(group):
+            decide_slot(group, min(group.inflight_slots))
+            progress = True
+
+        # Timeout on the oldest slot in flight
+        if group.inflight_slots:
+            oldest_send_time = group.inflight_slots[min(group.inflight_slots)][2]
+            if time.time() - oldest_send_time > (TIMEOUT_TIME):  # Check if TIMEOUT seconds have elapsed
+                print("TIMEOUT: Accepted messages not received, running new leader election again.")
+                group.leader = -1
+
+                # Hand the undecided values back to consensus in slot order
+                values = [group.inflight_slots[slot][1] for slot in sorted(group.inflight_slots)]
+                with group.consensus_condition:
+                    for slot in list(group.inflight_slots):
+                        del group.consensus_accepted[ballot_to_string(group.inflight_slots[slot][0])]
+                    group.inflight_slots.clear()
+
+                # Restart leader election
+                for value in values:
+                    for operation in operations_in(value):
+                        get_consensus(operation["user_message"], operation["request_id"])
+                return
+
+        if not progress:
+            wait_for_leader_work(group, recovered_values)
 
-            if accept_val == -1:
-                #Pop the next operation
-                user_message = pending_operations.get()
-                accept_val = user_message
+def oldest_slot_has_quorum(group):
+    """
+    Returns:
+        bool: True if the lowest slot in flight reached a phase-2 quorum (this server counts itself).
+    """
+    with group.consensus_condition:
+        if not group.inflight_slots:
+            return False
+        ball_num = group.inflight_slots[min(group.inflight_slots)][0]
+        return group.consensus_accepted.get(ballot_to_string(ball_num), 0) >= phase2_quorum - 1
 
-            # Use leader's ballot_number and accept_val
-            accept_message_args = {
-                "ballot_number": ball_num,
-                "accept_val": accept_val,
-            }
-            #Send Accept? message to all servers with message
-            consensus_accepted[ballot_to_string(ball_num)] = 0
+def wait_for_leader_work(group, recovered_values):
+    """
+    Block the leader loop until it can make progress: the oldest slot reached quorum,
+    an operation is waiting and the window has room, the ballot changed, the oldest
+    slot timed out, or the server is stopping.
+    """
+    def has_work():
+        window_open = len(group.inflight_slots) < PIPELINE_WINDOW and (recovered_values or not group.pending_operations.empty())
+        return (stop_event.is_set() or group.ballot_number["pid"] != SERVER_NUM
+                or window_open or oldest_slot_has_quorum(group))
 
-           
+    timeout = TIMEOUT_TIME
+    if group.inflight_slots:
+        timeout = max(0, group.inflight_slots[min(group.inflight_slots)][2] + TIMEOUT_TIME - time.time())
 
-            # added by Nik
-            if ballot_number["pid"] != SERVER_NUM:
-                leader = ballot_number["pid"]
-                return
-            
-            send_server_message(message.ACCEPT, -1, accept_message_args)
-
-
-            # Wait for all servers to respond with a timeout
-            start_time = time.time()  # Record the start time
-            while consensus_accepted[ballot_to_string(ball_num)] < MAX_SERVER_NUM - 2:
-                time.sleep(0.1)
-                if time.time() - start_time > (TIMEOUT_TIME):  # Check if TIMEOUT seconds have elapsed
-                    print("TIMEOUT: Accepted messages not received, running new leader election again.")
-                    leader = -1
-
-                    # Restart leader election
-                    #leader_init()
-                    get_consensus(accept_val)
-                    accept_val = -1
-                    accept_num = -1
-                    return
-                #If program gets told Kill message, exit gracefully
-                if stop_event.is_set():
-                    return
-            
-            del consensus_accepted[ballot_to_string(ball_num)]
+    with group.consensus_condition:
+        group.consensus_condition.wait_for(has_work, timeout=timeout)
 
-            #Broadcast consensus decide
-            decide_message_args = {
-                "accept_val": accept_val,
-            }
-            send_server_message(message.DECIDE, -1, decide_message_args)
-            
-            #Do Operation Locally (mimic message with minimum pieces needed)
-            local_decide_message = {
-                "args": decide_message_args,
-            }
-            server_consensus_decide_message(local_decide_message)
+def next_batch(group):
+    """
+    Drain up to BATCH_MAX_OPS operations, or BATCH_MAX_BYTES of them, from pending_operations.
+    Operations already decided or still in flight in another slot are dropped.
+    Returns:
+        dict or list: A single operation, or a list of operations to run in one Paxos round,
+            -1 (no-op) if every queued operation was dropped.
+    """
+    with group.consensus_condition:
+        proposed = {operation["request_id"] for _, value, _ in group.inflight_slots.values() for operation in operations_in(value)}
+
+    batch = []
+    batch_bytes = 0
+    while len(batch) < BATCH_MAX_OPS and not group.pending_operations.empty():
+        # Only the leader thread takes from the queue, so the head cannot change under us
+        operation = group.pending_operations.queue[0]
+        if operation["request_id"] in group.decided_requests or operation["request_id"] in proposed:
+            group.pending_operations.get()
+            continue
+        if batch and batch_bytes + len(operation["user_message"]) > BATCH_MAX_BYTES:
+            break
+        batch.append(group.pending_operations.get())
+        batch_bytes += len(operation["user_message"])
+
+    if not batch:
+        return -1
+    return batch[0] if len(batch) == 1 else batch
 
+def propose_slot(group, slot, value):
+    """
+    Send ACCEPT for value in slot with the leader's current ballot.
+    """
+    ball_num = copy.deepcopy(group.ballot_number)
+    ball_num["op_num"] = slot
+
+    # The leader accepts its own proposal so a future leader can recover it
+    group.accepted_slots[slot] = {"accept_num": ball_num, "accept_val": value}
+    log_state(group, {"type": "accept", "slot": slot, "accept_num": ball_num, "accept_val": value})
+    with group.consensus_condition:
+        group.consensus_accepted[ballot_to_string(ball_num)] = 0
+        group.inflight_slots[slot] = (ball_num, value, time.time())
+
+    # Use leader's ballot_number and accept_val
+    accept_message_args = {
+        "ballot_number": ball_num,
+        "accept_val": value,
+        "op_num": group.ballot_number["op_num"]
+    }
+    send_server_message(message.ACCEPT, -1, accept_message_args, group=group)
 
-def server_leader_forward_message(message_data):
+def decide_slot(group, slot):
+    """
+    Broadcast DECIDE for a slot that reached quorum and apply it locally.
+    """
+    with group.consensus_condition:
+        ball_num, value, _ = group.inflight_slots.pop(slot)
+        del group.consensus_accepted[ballot_to_string(ball_num)]
+
+    #Broadcast consensus decide
+    decide_message_args = {
+        "ballot_number": ball_num,
+        "accept_val": value,
+    }
+    send_server_message(message.DECIDE, -1, decide_message_args, group=group)
+
+    #Do Operation Locally (mimic message with minimum pieces needed)
+    local_decide_message = {
+        "args": decide_message_args,
+    }
+    server_consensus_decide_message(group, local_decide_message)
+
+def remove_pending_operation(group, operation):
+    """
+    Drop an operation from the queue when it is already being re-proposed.
+    """
+    with group.pending_operations.mutex:
+        for queued in list(group.pending_operations.queue):
+            if queued["request_id"] == operation["request_id"]:
+                group.pending_operations.queue.remove(queued)
+
+
+def server_leader_forward_message(group, message_data):
     """
     As the leader, insert recieved message into service queue
     """
     sending_server = message_data.get("sending_server")
     args = message_data.get("args", {})
-    user_message = args.get("user_message")
+    operation = {"request_id": args.get("request_id"), "user_message": args.get("user_message")}
     #ballot = args.get("ballot_number")
 
     # Don't respond if server doesn't know that it is leader
-    if(SERVER_NUM == leader):
-        insert_operation_to_queue(user_message) 
-        send_server_message(message.LEADER_ACK, sending_server, args)
+    if(SERVER_NUM == group.leader):
+        insert_operation_to_queue(group, operation)
+        send_server_message(message.LEADER_ACK, sending_server, args, group=group)
 
 def server_leader_ack_message(message_data):
-    global leader_ack
-    leader_ack = 1
+    args = message_data.get("args", {})
+    complete_request_ack(args.get("request_id"), message_data.get("sending_server"))
 
-def server_consensus_accepted_message(message_data):
+def server_consensus_accepted_message(group, message_data):
     args = message_data.get("args", {})
     
     # Handle case that an acceptor is behind in number of operation by sending them an update context message
     if args.get("help"): 
-        message_args = {
-                # TODO: Is KeyValue the best way to send all of the context?
-                "context": keyValue.to_dict(),  # Serialize the KeyValue object
-                "op_num": ballot_number["op_num"],
-                "leader": leader
-        }
-        send_server_message(message.UPDATE_CONTEXT, message_data.get("sending_server"), message_args)
+        send_update_context(group, message_data.get("sending_server"), args.get("op_num"))
         
-    time.sleep(.2)
-
-    #increment consensus accepted counter for the ballot
+    #increment consensus accepted counter for the ballot and wake the leader
     b = ballot_to_string(args.get("ballot_number"))
-    if b in consensus_accepted:
-        consensus_accepted[b] += 1
+    with group.consensus_condition:
+        if b in group.consensus_accepted:
+            group.consensus_accepted[b] += 1
+            group.consensus_condition.notify_all()
 
-def server_consensus_accept_message(message_data):
+def server_consensus_accept_message(group, message_data):
     
-    global ballot_number
-    global accept_val
-    global accept_num
     args = message_data.get("args", {})
     ballot = args.get("ballot_number")
+    slot = ballot["op_num"]
     sending_server = message_data.get("sending_server")
     
     # Return Accept if sender has higher ballot than own ballot
-    if ballot["seq_num"] > ballot_number["seq_num"] or (ballot["seq_num"] == ballot_number["seq_num"] and ballot["pid"] == ballot_number["pid"]) or (ballot["seq_num"] == ballot_number["seq_num"] and ballot["pid"] > ballot_number["pid"]):
+    if ballot["seq_num"] > group.ballot_number["seq_num"] or (ballot["seq_num"] == group.ballot_number["seq_num"] and ballot["pid"] == group.ballot_number["pid"]) or (ballot["seq_num"] == group.ballot_number["seq_num"] and ballot["pid"] > group.ballot_number["pid"]):
         
-        # If proposer's op_num is lower, send own context to update their context with up-to-date operations
-        if ballot["op_num"] < ballot_number["op_num"]:
-            message_args = {
-                # TODO: Is KeyValue the best way to send all of the context?
-                "context": keyValue.to_dict(),
-                "op_num": ballot_number["op_num"]
-            }
-            send_server_message(message.UPDATE_CONTEXT, sending_server, message_args)
-            ballot_number["seq_num"] = ballot["seq_num"]
+        # If the slot is already applied here the proposer is behind, send own context to update their context with up-to-date operations
+        if slot < group.ballot_number["op_num"]:
+            send_update_context(group, sending_server, args.get("op_num"))
+            group.ballot_number["seq_num"] = ballot["seq_num"]
 
         
         # Send an accepted message to proposer otherwise
         else:
-            # Server accepts value and logs it in case leader fails
+            # Server accepts value for the slot and logs it in case leader fails
             accept_val = args.get("accept_val")
-            accept_num = ballot
+            group.accepted_slots[slot] = {"accept_num": ballot, "accept_val": accept_val}
+            log_state(group, {"type": "accept", "slot": slot, "accept_num": ballot, "accept_val": accept_val})
 
-            # Set a help flag if acceptor has a lower number of operations completed than leader
-            help_needed = ballot["op_num"] > ballot_number["op_num"]
+            # Set a help flag if the leader has applied operations this server has not
+            help_needed = args.get("op_num", 0) > group.ballot_number["op_num"]
 
-            # Set maximum known ballot number to recieved ballot
-            ballot_number = ballot
+            # Set maximum known ballot number to recieved ballot, op_num keeps counting applied operations
+            group.ballot_number["seq_num"] = ballot["seq_num"]
+            group.ballot_number["pid"] = ballot["pid"]
+            notify_consensus(group)
             
             message_args = {
-                "ballot_number": ballot_number,
+                "ballot_number": ballot,
                 "accept_val": accept_val,
-                "help": help_needed
+                "help": help_needed,
+                "op_num": group.ballot_number["op_num"]
             }
-            send_server_message(message.ACCEPTED, sending_server, message_args)
+            send_server_message(message.ACCEPTED, sending_server, message_args, group=group)
             
             # Set sending server to leader for future reference
-            global leader
-            leader = sending_server
+            group.leader = sending_server
 
             
 
 
-def server_consensus_decide_message(message_data):
-    
-    #Increment local ballot_number
-    ballot_number["op_num"] += 1
+def server_consensus_decide_message(group, message_data):
+    """
+    Record a decided slot and apply every decided slot that is next in order.
+    """
+    args = message_data.get("args", {})
+    slot = args.get("ballot_number")["op_num"]
+
+    with group.apply_lock:
+        # Ignore decisions for slots already applied
+        if slot < group.ballot_number["op_num"]:
+            return
 
-    # Reset accept_val and accept_num
-    global accept_val
-    global accept_num
-    accept_val = -1
-    accept_num = -1
+        group.decided_slots[slot] = args.get("accept_val")
+        apply_decided_slots(group)
+        op_num = group.ballot_number["op_num"]
 
+    # Decisions reach every server in slot order, so a slot still waiting here means one was missed
+    sending_server = message_data.get("sending_server")
+    if op_num <= slot and sending_server is not None and sending_server != SERVER_NUM:
+        request_catch_up(group, sending_server, op_num)
+
+def request_catch_up(group, leader_num, op_num):
+    """
+    Ask the leader for the decisions this server is missing, at most once per
+    TIMEOUT_TIME for the same op_num in case the reply is lost.
+    """
+    now = time.time()
+    if group.catch_up_request is not None and group.catch_up_request[0] == op_num and now - group.catch_up_request[1] < TIMEOUT_TIME:
+        return
+    group.catch_up_request = (op_num, now)
+    send_server_message(message.CATCH_UP, leader_num, {"op_num": op_num}, group=group)
+
+def server_catch_up_message(group, message_data):
+    """
+    Send the decisions a server reported missing, as a log suffix or a snapshot.
+    """
+    send_update_context(group, message_data.get("sending_server"), message_data.get("args", {}).get("op_num"))
+
+def apply_decided_slots(group, generate=True, replayed_slots=()):
+    """
+    Apply decided values in slot order, stopping at the first slot not yet decided.
+    Args:
+        generate (bool): Whether queries query the LLM. False when catching up on
+            operations the rest of the cluster already answered.
+        replayed_slots (set): Slots learned from a catch-up log, applied without querying the LLM.
+    """
+    with group.apply_lock:
+        while group.ballot_number["op_num"] in group.decided_slots:
+            slot = group.ballot_number["op_num"]
+            user_message = group.decided_slots.pop(slot)
+            group.accepted_slots.pop(slot, None)
+
+            # Decisions can be learned again from other servers, so they don't wait for the fsync
+            log_state(group, {"type": "decide", "slot": slot, "accept_val": user_message}, durable=False)
+
+            # Keep the value for catching up other servers, forgetting the oldest beyond retention
+            group.decided_log[slot] = user_message
+            while len(group.decided_log) > LOG_RETENTION:
+                group.decided_log.popitem(last=False)
+
+            #Increment local ballot_number
+            group.ballot_number["op_num"] += 1
+
+            # Apply every operation of the slot in order, mimicking a decide message with
+            # the pieces the operation handlers need. An operation decided in an earlier
+            # slot too is skipped, every server skips the same ones as they apply in slot order
+            for operation in operations_in(user_message):
+                request_id = operation["request_id"]
+                if request_id is not None:
+                    if request_id in group.decided_requests:
+                        continue
+                    group.decided_requests[request_id] = slot
+                    while len(group.decided_requests) > REQUEST_ID_RETENTION:
+                        group.decided_requests.popitem(last=False)
+                apply_decided_operation(group, {"args": {"accept_val": operation["user_message"]}}, generate and slot not in replayed_slots)
+                complete_request_decided(group, request_id)
+
+        maybe_snapshot(group)
+
+def apply_decided_operation(group, message_data, generate=True):
     args = message_data.get("args", {})
     user_message = args.get("accept_val")
 
-    if user_message == -1:
-        return
-    elif user_message.startswith("create"):
-        server_new_context(user_message)
+    if user_message.startswith("create"):
+        server_new_context(group, user_message)
     elif user_message.startswith("query"):
-        server_create_query(message_data)
+        server_create_query(group, message_data, generate)
     elif user_message.startswith("choose"):
-        server_choose_response(message_data)
+        server_choose_response(group, message_data)
     else:
         print(f"UNSUPPORTED SERVER CONSENSUS DECIDE MESSAGE: {user_message}")
 
 
 # ------ GEMINI ------
 
-def setup_gemini():
-    # Load environment variables from .env file
-    load_dotenv()
-
-    # Configure the Gemini API using the loaded environment variable
-    genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-
+# Client in front of the backend chosen with the LLM_BACKEND environment variable, created when the server starts
+llm_client = None
 
 def query_gemini(context, prompt_answer="Answer: "):
     """
-    Query the Gemini LLM with a given context and prompt.
+    Query the configured LLM backend (Gemini unless LLM_BACKEND says otherwise)
+    with a given context and prompt, answering repeated prompts from response_cache.
     Args:
         context (str): The context string to send to Gemini.
         prompt_answer (str): The prompt indicating where Gemini should generate a response.
     Returns:
-        str: The generated response text from Gemini.
+        str: The generated response text from Gemini, or None if generation failed.
     """
+    prompt = context + prompt_answer
+    cached = response_cache.get(llm_client.name, prompt)
+    if cached is not None:
+        return cached
+
     try:
-        # Initialize the Gemini generative model
-        model = genai.GenerativeModel("gemini-1.5-flash")
-        
         # Generate content using the context and prompt
-        response = model.generate_content(context + prompt_answer)
-        return response.text  # Return the generated text
-    except Exception as e:
+        response = llm_client.generate(prompt)
+    except LLMError as e:
         print(f"Error querying Gemini: {e}")
-        return "Error querying Gemini API"
+        return None
+
+    # Only successful responses are cached, errors are retried next time
+    response_cache.put(llm_client.name, prompt, response)
+    return response  # Return the generated text
+
+
+def stream_gemini(context, prompt_answer="Answer: "):
+    """
+    Like query_gemini(), but yield the response in pieces as they are generated.
+    A cached response is yielded as a single piece and a completed stream is cached.
+    Raises:
+        LLMError: If generation failed, possibly after some pieces were yielded.
+    """
+    prompt = context + prompt_answer
+    cached = response_cache.get(llm_client.name, prompt)
+    if cached is not None:
+        yield cached
+        return
+
+    pieces = []
+    for piece in llm_client.stream(prompt):
+        pieces.append(piece)
+        yield piece
+
+    # Only complete responses are cached
+    response_cache.put(llm_client.name, prompt, "".join(pieces))
 
 
 if __name__ == "__main__":
     print("Server")
+    llm_client = LLMClient(
+        create_backend(),
+        max_concurrency=LLM_MAX_CONCURRENCY,
+        rate=LLM_RATE_LIMIT,
+        burst=LLM_RATE_BURST,
+        max_retries=LLM_MAX_RETRIES,
+        backoff_base=LLM_BACKOFF_BASE,
+        backoff_max=LLM_BACKOFF_MAX,
+        deadline=LLM_DEADLINE
+    )
     connect_server()
     threading.Thread(target=get_user_input).start()
     
     while not stop_event.is_set():
         time.sleep(0.5)
+
+    # Flush decisions still waiting for the group commit
+    for group in groups:
+        if group.wal is not None:
+            group.wal.close()
+
+    # Don't start generations nobody will read
+    llm_pool.shutdown(wait=False, cancel_futures=True)
         
     sys.stdout.flush()
     sys.exit(0)
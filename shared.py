@@ -1,5 +1,7 @@
 # constants.py
 
+import json
+import struct
 from enum import Enum
 
 class message(Enum):
@@ -24,13 +26,210 @@ class message(Enum):
     # Used to update context and op_num
     UPDATE_CONTEXT = 11
 
+    # Used to announce a new cluster size when a node joins
+    CLUSTER_UPDATE = 12
+
+    # Used to stream a KeyValue snapshot to a lagging server
+    SNAPSHOT_CHUNK = 13
+
+    # Used by a server that missed decisions to ask the leader for them
+    CATCH_UP = 14
+
 
 NETWORK_SERVER_PORT = 9000
-MAX_SERVER_NUM = 3
+MAX_SERVER_NUM = 3  # Default cluster size, override with `python3 network_server.py <cluster_size>`
 DELAY = 3
 TIMEOUT_TIME = DELAY * 3
+DECIDE_TIMEOUT = TIMEOUT_TIME * 2  # Seconds an acknowledged operation may wait to be decided before it is submitted again
+NUM_CONSENSUS_GROUPS = 4  # Independent Paxos groups, each ordering the operations of the contexts that hash to it
+PIPELINE_WINDOW = 4  # Maximum log slots the leader keeps in flight at once
+BATCH_MAX_OPS = 16  # Maximum user operations the leader batches into one slot
+BATCH_MAX_BYTES = 64 * 1024  # Maximum total size of the operations batched into one slot
+LOG_RETENTION = 1024  # Decided slots kept in memory for catching up lagging replicas
+REQUEST_ID_RETENTION = 100000  # Request IDs of applied operations remembered per group, so resubmitted operations are applied once
+DATA_DIR = "data"  # Durable per-server state is kept in DATA_DIR/server_<num>/, WAL and snapshots in group_<id>/ below it
+SNAPSHOT_INTERVAL_OPS = 1000  # Take a snapshot after this many operations since the last one
+SNAPSHOT_INTERVAL_BYTES = 16 * 1024 * 1024  # or once the current WAL segment grows past this size
+SNAPSHOT_CHUNK_BYTES = 64 * 1024  # Uncompressed size of the contexts sent in one SNAPSHOT_CHUNK
+SNAPSHOT_CHUNK_INTERVAL = 0.05  # Seconds between the chunks of a transfer, so other traffic is relayed in between
+LLM_WORKERS = 4  # Threads generating LLM responses for decided queries
+LLM_CACHE_MAX_ENTRIES = 1024  # Responses kept in the LLM response cache
+LLM_CACHE_MAX_BYTES = 16 * 1024 * 1024  # Total length of the responses kept in the cache
+LLM_CACHE_PERSIST = True  # Keep the cache in DATA_DIR/server_<num>/llm_cache.jsonl across restarts
+LLM_MAX_CONCURRENCY = 4  # LLM calls in progress at once per server
+LLM_RATE_LIMIT = 5.0  # LLM calls started per second per server, on average
+LLM_RATE_BURST = 5  # LLM calls that may start at once after an idle period
+LLM_MAX_RETRIES = 3  # Retries of an LLM call that failed with a transient error
+LLM_BACKOFF_BASE = 0.5  # Seconds before the first retry, doubled for every retry after it
+LLM_BACKOFF_MAX = 8.0  # Upper bound on the backoff between retries
+LLM_DEADLINE = 30.0  # Seconds a query may spend on rate limiting, calls and retries in total
+LLM_STREAM = True  # Deliver candidates in chunks as they are generated instead of once complete
+PROMPT_BUDGET_CHARS = 16000  # Characters of the most recent Query/Answer turns sent to the LLM
+PROMPT_SUMMARY_CHARS = 2000  # Characters of the summary of older turns sent along with them, 0 to drop them
+
+
+def quorum_sizes(cluster_size, phase2_quorum=None):
+    """
+    Compute the phase-1 (PREPARE/PROMISE) and phase-2 (ACCEPT/ACCEPTED) quorum sizes.
+    Both are a majority by default. With a flexible phase2_quorum, phase 1 grows
+    so that every phase-1 quorum still intersects every phase-2 quorum.
+    Args:
+        cluster_size (int): Number of replicas in the cluster.
+        phase2_quorum (int): Optional phase-2 quorum size (flexible quorums).
+    Returns:
+        tuple: (phase1, phase2) quorum sizes, counting the leader itself.
+    """
+    majority = cluster_size // 2 + 1
+    if phase2_quorum is None:
+        return majority, majority
+
+    phase2 = max(1, min(phase2_quorum, cluster_size))
+    phase1 = cluster_size - phase2 + 1
+    return phase1, phase2
+
+
+# Frame header: payload length (uint32), message type (uint8), dest_server (int16), sending_server (int16)
+# The routing fields repeat the JSON ones so the network server can forward without decoding the payload
+FRAME_HEADER = struct.Struct("!IBhh")
+RECV_BUFFER_SIZE = 64 * 1024
+MIN_RECV_SIZE = 4096
+
+
+def pack_frame(message_type, dest_server, sending_server, payload):
+    """
+    Prefix an already serialized payload with the frame header.
+    """
+    return FRAME_HEADER.pack(len(payload), message_type, dest_server, sending_server) + payload
+
+
+def encode_frame(message_data):
+    """
+    Serialize message_data to JSON and prefix it with the frame header.
+    Returns:
+        bytes: The complete frame ready to be written to a socket.
+    """
+    payload = json.dumps(message_data).encode('utf-8')
+    return pack_frame(message_data["message_type"], message_data["dest_server"], message_data["sending_server"], payload)
+
+
+def send_frame(sock, message_data):
+    """
+    Send message_data as a single frame, retrying partial writes with sendall.
+    """
+    sock.sendall(encode_frame(message_data))
+
+
+class FrameReader:
+    """
+    Reassembles length-prefixed frames from a stream socket.
+    Data is received straight into a reusable bytearray with recv_into and
+    each payload is sliced out exactly once, so a frame costs O(size) no matter
+    how many reads it arrived in.
+    """
+
+    def __init__(self, size=RECV_BUFFER_SIZE):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # First byte not yet returned as part of a frame
+        self.end = 0    # One past the last byte received
+
+    def _bytes_wanted(self):
+        """
+        Number of bytes still missing from the frame at the head of the buffer.
+        """
+        pending = self.end - self.start
+        if pending < FRAME_HEADER.size:
+            return FRAME_HEADER.size - pending
+        length = FRAME_HEADER.unpack_from(self.buffer, self.start)[0]
+        return FRAME_HEADER.size + length - pending
+
+    def _reserve(self, needed):
+        """
+        Make sure there is room for at least `needed` bytes after self.end,
+        compacting the unread bytes to the front or growing the buffer.
+        """
+        if len(self.buffer) - self.end >= needed:
+            return
+
+        pending = self.end - self.start
+        if len(self.buffer) - pending >= needed:
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+        else:
+            new_buffer = bytearray(max(len(self.buffer) * 2, pending + needed))
+            new_buffer[:pending] = self.view[self.start:self.end]
+            self.buffer = new_buffer
+            self.view = memoryview(new_buffer)
+        self.start, self.end = 0, pending
+
+    def get_buffer(self, sizehint=-1):
+        """
+        Return a writable memoryview over the free space of the buffer.
+        Large enough for the rest of the current frame when its header is known.
+        """
+        self._reserve(max(sizehint, MIN_RECV_SIZE, self._bytes_wanted()))
+        return self.view[self.end:]
+
+    def buffer_updated(self, nbytes):
+        """
+        Record that nbytes were written into the view returned by get_buffer().
+        """
+        self.end += nbytes
+
+    def recv_from(self, sock):
+        """
+        Receive once from sock into the buffer.
+        Returns:
+            int: Number of bytes received (0 when the peer closed the connection).
+        """
+        nbytes = sock.recv_into(self.get_buffer())
+        self.buffer_updated(nbytes)
+        return nbytes
+
+    def _next_frame(self):
+        """
+        Returns:
+            tuple: (message_type, dest_server, sending_server, frame_start, payload_start, frame_end)
+                   for the frame at the head of the buffer, or None if it is incomplete.
+        """
+        if self.end - self.start < FRAME_HEADER.size:
+            return None
+        length, message_type, dest_server, sending_server = FRAME_HEADER.unpack_from(self.buffer, self.start)
+        payload_start = self.start + FRAME_HEADER.size
+        if payload_start + length > self.end:
+            return None
+        return message_type, dest_server, sending_server, self.start, payload_start, payload_start + length
+
+    def _consumed(self, frame_end):
+        self.start = frame_end
+        if self.start == self.end:
+            self.start = self.end = 0
+
+    def frames(self):
+        """
+        Yield (message_type, payload) for every complete frame in the buffer.
+        """
+        while (frame := self._next_frame()) is not None:
+            message_type, _, _, _, payload_start, frame_end = frame
+            payload = bytes(self.view[payload_start:frame_end])
+            self._consumed(frame_end)
+            yield message_type, payload
+
+    def routed_frames(self):
+        """
+        Yield (message_type, dest_server, sending_server, frame) for every complete frame,
+        where frame is the original header and payload bytes, ready to be forwarded untouched.
+        """
+        while (frame := self._next_frame()) is not None:
+            message_type, dest_server, sending_server, frame_start, _, frame_end = frame
+            frame_bytes = bytes(self.view[frame_start:frame_end])
+            self._consumed(frame_end)
+            yield message_type, dest_server, sending_server, frame_bytes
+
 
 """
+Frame Format:
+    <payload length: uint32> <message_type: uint8> <dest_server: int16> <sending_server: int16> <payload: UTF-8 JSON>
+
 JSON Format:
 
 message_data
@@ -38,37 +237,65 @@ message_data
     "sending_server": int 
     "message_type": int
     "args":
+        "group": int (PREPARE through DECIDE, UPDATE_CONTEXT, SNAPSHOT_CHUNK and CATCH_UP: the consensus group the message belongs to)
         if SERVER_INIT:
             "server_num": int
+            "cluster_size": int
+            "phase2_quorum": int or None
         if SERVER_KILL:
         if PREPARE:
             "ballot_number": dictionary
         if PROMISE:
             "ballot_number": dictionary
-            "accept_val": string or -1
-            "accept_num": dict or -1
+            "accepted": list of [slot, accept_num, accept_val]
+            "help": bool
+            "op_num": int (operations applied by the sender)
 
         if LEADER_FORWARD:
             "user_message": string
+            "request_id": string (unique per submitted operation, kept across resubmissions)
         if LEADER_ACK:
             "user_message": string
+            "request_id": string
         if ACCEPT:
             "ballot_number": dictionary
-            "accept_val": string
-            "accept_num": dict
+            "accept_val": operation {"request_id", "user_message"} or list of operations (batch)
+            "op_num": int (operations applied by the sender)
         if ACCEPTED:
             "ballot_number": dictionary
-            "accept_val": string
+            "accept_val": operation {"request_id", "user_message"} or list of operations (batch)
+            "help": bool
+            "op_num": int (operations applied by the sender)
         if DECIDE:
-            "accept_val": string
+            "ballot_number": dictionary (op_num is the decided slot)
+            "accept_val": operation {"request_id", "user_message"} or list of operations (batch)
         if LLM_RESPONSE:
             "context_id": int
             "query_string": string
-            "response":d string
+            "candidate_id": string (unique per generated response)
+            "chunk_index": int (chunks of a candidate are numbered from 0)
+            "response": string (text of this chunk)
+            "final": bool (the candidate is complete, sent as an extra empty chunk)
+            "truncated": bool (final chunk only, generation failed part way and the candidate must not be chosen)
         if UPDATE_CONTEXT:
-            "context": KeyValue
             "op_num": int
             "leader": int
+            "log_start": int (slot of the first entry of the decided values the receiver is missing)
+            "log": list of accept_val
+        if CLUSTER_UPDATE:
+            "cluster_size": int
+            "phase2_quorum": int or None
+        if SNAPSHOT_CHUNK:
+            "transfer_id": string
+            "index": int (chunks of a transfer are numbered from 0)
+            "data": string (base64 of zlib compressed JSON {context_id: context data})
+            "crc": int (crc32 of the compressed data)
+            "final": bool
+            "op_num": int (op_num of the snapshot)
+            "leader": int
+            "requests": list of [request_id, slot] (final chunk only, request IDs of the applied operations)
+        if CATCH_UP:
+            "op_num": int (operations applied by the sender)
 
 
 """
\ No newline at end of file
@@ -0,0 +1,61 @@
+"""traffic_trace.py"""
+
+import struct
+
+# Trace file layout:
+#   TRACE_MAGIC, then one record per frame:
+#   <timestamp: float64> <src: int16> <dest: int16> <message_type: uint8> <payload length: uint32> <payload>
+TRACE_MAGIC = b"RELAYTRACE1\n"
+RECORD_HEADER = struct.Struct("!dhhBI")
+
+
+class TraceWriter:
+    """Append-only writer for relay traffic traces."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(TRACE_MAGIC)
+        self.records = 0
+
+    def write(self, timestamp, src, dest, message_type, payload):
+        """
+        Append one frame to the trace.
+        Args:
+            timestamp (float): Time the frame was forwarded, in seconds.
+            src (int): Sending server (-1 for the network server).
+            dest (int): Destination server (-1 for broadcast).
+            message_type (int): Value of the message enum.
+            payload (bytes): The frame payload exactly as relayed.
+        """
+        self.file.write(RECORD_HEADER.pack(timestamp, src, dest, message_type, len(payload)))
+        self.file.write(payload)
+        self.records += 1
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_trace(path):
+    """
+    Iterate over the records of a trace file.
+    Yields:
+        tuple: (timestamp, src, dest, message_type, payload)
+    """
+    with open(path, "rb") as f:
+        if f.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+            raise ValueError(f"{path} is not a relay trace file")
+
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            timestamp, src, dest, message_type, length = RECORD_HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                return  # Truncated final record from an interrupted capture
+            yield timestamp, src, dest, message_type, payload
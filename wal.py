@@ -0,0 +1,233 @@
+"""wal.py"""
+
+import os
+import json
+import zlib
+import struct
+import threading
+
+# WAL segment layout: one record per entry
+#   <payload length: uint32> <crc32 of payload: uint32> <payload: JSON>
+# A directory holds segments named wal.<first op_num>.log, a new one is started at every snapshot
+RECORD_HEADER = struct.Struct("!II")
+SEGMENT_FORMAT = "wal.{:012d}.log"
+
+# Snapshot layout: SNAPSHOT_MAGIC, RECORD_HEADER of the compressed payload, zlib compressed JSON
+SNAPSHOT_MAGIC = b"SNAPSHOT1\n"
+SNAPSHOT_FILE = "snapshot.z"
+
+
+class WriteAheadLog:
+    """
+    Append-only log of consensus state with group commit.
+    Appends are buffered in memory and a single flusher thread writes and fsyncs
+    everything buffered so far in one go, so every append waiting on the same
+    fsync shares its cost instead of paying for one each. The flusher also owns
+    the segment files, so rolling to a new segment never waits on the disk.
+    """
+
+    def __init__(self, directory, start_op_num=0):
+        self.directory = directory
+
+        # Keep appending to the newest segment, dropping a torn tail left by a crash so new records stay readable
+        segments = list_segments(directory)
+        if segments:
+            self.start_op_num, path = segments[-1]
+        else:
+            self.start_op_num = start_op_num
+            path = os.path.join(directory, SEGMENT_FORMAT.format(start_op_num))
+        valid_length = 0
+        for valid_length, _ in scan_segment(path):
+            pass
+        self.file = open(path, "ab")
+        self.file.truncate(valid_length)
+        self.segment_bytes = valid_length  # Bytes in the current segment, used to trigger snapshots
+
+        self.condition = threading.Condition()
+        self.buffer = []  # Encoded records, and the first op_num of a new segment where roll() was called
+        self.appended = 0  # Sequence number of the last buffered record
+        self.durable = 0  # Sequence number of the last record known to be on disk
+        self.closed = False
+        self.flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self.flusher.start()
+
+    def append(self, record, durable=True):
+        """
+        Add a record to the log.
+        Args:
+            record (dict): JSON serializable entry.
+            durable (bool): Block until the record has been fsynced.
+        """
+        payload = json.dumps(record).encode()
+        with self.condition:
+            if self.closed:
+                return
+            self.buffer.append(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+            self.appended += 1
+            self.segment_bytes += RECORD_HEADER.size + len(payload)
+            sequence = self.appended
+            self.condition.notify_all()
+
+            if durable:
+                self.condition.wait_for(lambda: self.durable >= sequence or self.closed)
+
+    def _flush_loop(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.buffer or self.closed)
+                if not self.buffer and self.closed:
+                    return
+                pending, self.buffer = self.buffer, []
+                sequence = self.appended
+                file = self.file
+
+            # Write and fsync outside the lock so appends keep buffering meanwhile,
+            # switching segments where roll() was called
+            records = []
+            for entry in pending:
+                if isinstance(entry, bytes):
+                    records.append(entry)
+                    continue
+                self._write(file, records)
+                file.close()
+                file = open(os.path.join(self.directory, SEGMENT_FORMAT.format(entry)), "ab")
+                records = []
+            self._write(file, records)
+
+            with self.condition:
+                self.file = file
+                self.durable = sequence
+                self.condition.notify_all()
+
+    @staticmethod
+    def _write(file, records):
+        file.write(b"".join(records))
+        file.flush()
+        os.fsync(file.fileno())
+
+    def roll(self, start_op_num):
+        """
+        Direct every later append to a new segment starting at start_op_num without
+        waiting: the flusher finishes the current segment and switches files in order.
+        """
+        with self.condition:
+            if self.closed:
+                return
+            self.buffer.append(start_op_num)
+            self.start_op_num = start_op_num
+            self.segment_bytes = 0
+            self.condition.notify_all()
+
+    def remove_segments_before(self, start_op_num):
+        """
+        Delete the segments fully covered by a snapshot taken at start_op_num.
+        """
+        for segment_start, path in list_segments(self.directory):
+            if segment_start < start_op_num and segment_start < self.start_op_num:
+                os.remove(path)
+
+    def close(self):
+        """
+        Flush everything appended so far and close the file.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.flusher.join()
+        self.file.close()
+
+
+def list_segments(directory):
+    """
+    Returns:
+        list: (first op_num, path) of every WAL segment in directory, oldest first.
+    """
+    segments = []
+    for name in os.listdir(directory):
+        if name.startswith("wal.") and name.endswith(".log"):
+            try:
+                segments.append((int(name[len("wal."):-len(".log")]), os.path.join(directory, name)))
+            except ValueError:
+                continue
+    return sorted(segments)
+
+
+def read_wal(directory, from_op_num=0):
+    """
+    Iterate over the records of every segment starting at or after from_op_num,
+    stopping at a torn or corrupt tail.
+    Yields:
+        dict: The records in the order they were appended.
+    """
+    for segment_start, path in list_segments(directory):
+        if segment_start < from_op_num:
+            continue
+        for _, record in scan_segment(path):
+            yield record
+
+
+def scan_segment(path):
+    """
+    Yields:
+        tuple: (offset just past the record, record) for every valid record.
+    """
+    if not os.path.exists(path):
+        return
+
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            length, checksum = RECORD_HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(payload) != checksum:
+                return  # Crash in the middle of a write
+            yield f.tell(), json.loads(payload)
+
+
+def write_snapshot(directory, encoded_state):
+    """
+    Compress and atomically replace the snapshot in directory.
+    Args:
+        encoded_state (bytes): JSON encoded state.
+    """
+    payload = zlib.compress(encoded_state)
+    path = os.path.join(directory, SNAPSHOT_FILE)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)))
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+    # Make the rename itself durable before older segments are deleted
+    directory_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(directory_fd)
+    finally:
+        os.close(directory_fd)
+
+
+def read_snapshot(directory):
+    """
+    Returns:
+        dict: The state stored by write_snapshot(), or None if there is no valid snapshot.
+    """
+    path = os.path.join(directory, SNAPSHOT_FILE)
+    if not os.path.exists(path):
+        return None
+
+    with open(path, "rb") as f:
+        if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            return None
+        header = f.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            return None
+        length, checksum = RECORD_HEADER.unpack(header)
+        payload = f.read(length)
+        if len(payload) < length or zlib.crc32(payload) != checksum:
+            return None
+    return json.loads(zlib.decompress(payload))